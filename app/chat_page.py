@@ -10,7 +10,7 @@ Sezione Chat (senza LangChain nel core; supporta reasoning separato) + Gestione
 - Selectbox per scegliere l'agente: ENV | SOCIAL | DSS (la history non viene resettata)
 - **Nuova Chat** (pulsante in fondo alla sidebar)
 - **Gestione Chat** (expander in sidebar con lista “scrollabile”, rinomina, elimina, apri)
-- **Salvataggio automatico** su file JSON (cartella configurabile) ad ogni fine messaggio (utente/assistant)
+- **Salvataggio automatico** append-only (cartella configurabile) ad ogni fine messaggio (utente/assistant)
 
 Dipendenze:
 - `utils.utils.event_stream` (core che chiama OpenAI SDK/Ollama-compat)
@@ -20,24 +20,63 @@ Note
 ----
 - Il toggle "Mostra blocchi Thinking" controlla solo la **visualizzazione** in UI.
   Il reasoning viene comunque salvato nel messaggio assistant (campo `think`).
-- Le chat sono salvate in JSON nella cartella CHATS_DIR (default: ./app/chats).
+- Lo stream di eventi del core gira su un event loop persistente di processo (se `uvloop` è
+  installato viene usato al posto del loop asyncio standard, disattivabile con JETSON_NO_UVLOOP=1)
+  e arriva al thread dello script tramite una coda: la UI è aggiornata solo da quest'ultimo.
+- Le chat sono salvate nella cartella CHATS_DIR (default: ./app/chats) come coppia
+  `<id>.meta.json` (nome, date, numero messaggi) + `<id>.jsonl` (un messaggio per riga).
 """
 
 import os
+import re
+import copy
 import json
 import uuid
+import time
+import queue
 import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, Iterator, List, Tuple, TypedDict
+
+try:  # lock sui file solo su POSIX (Jetson/Linux); su Windows si procede senza
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 import streamlit as st
 
+# Scrittura atomica (tmp + fsync + os.replace, permessi del file sostituito) condivisa con gli editor
+from utils.json_io import atomic_write_bytes as _atomic_write_bytes
+
 # Non filtriamo i blocchi <think> nel core, così la UI li può visualizzare se arrivano nel content
 os.environ.setdefault("HIDE_THINK", "false")
 
-# Import core (con event_stream(user_text, history, mode))
-from utils.utils import event_stream, MODEL
+
+@st.cache_resource(show_spinner=False)
+def _get_agent_runtime():
+    """
+    Import del core (client OpenAI + report placeholder) una sola volta per processo:
+    ritorna (MODEL, event_stream, agent_event_loop) con event_stream(user_text, history, mode).
+    Il client è un singleton di modulo: il suo pool HTTP keep-alive verso l'endpoint
+    resta aperto tra i turni (e tra le sessioni), insieme al loop persistente di processo.
+    """
+    from utils.utils import event_stream, MODEL, agent_event_loop
+    return MODEL, event_stream, agent_event_loop
+
+
+MODEL, event_stream, agent_event_loop = _get_agent_runtime()
+
+
+@st.cache_resource(show_spinner=False)
+def _tool_dataset_paths() -> Tuple[Path, ...]:
+    """File letti dai tool (sensori, social, targets): modificabili dalle pagine editor."""
+    from utils.tools import SENSOR_DATA_PATH, SOCIAL_DATA_PATH, KPI_TARGETS_PATH
+    return SENSOR_DATA_PATH, SOCIAL_DATA_PATH, KPI_TARGETS_PATH
 
 
 # ============================== Costanti & Storage ============================
@@ -46,66 +85,231 @@ from utils.utils import event_stream, MODEL
 CHATS_DIR = Path(os.getenv("CHATS_DIR", Path.cwd() / "app" / "chats"))
 CHATS_DIR.mkdir(parents=True, exist_ok=True)
 
+# Finestra scorrevole: messaggi tenuti in sessione (il transcript su file resta completo)
+# e messaggi inviati all'LLM
+MAX_UI_MESSAGES = int(os.getenv("MAX_UI_MESSAGES", "200"))
+MAX_LLM_MESSAGES = int(os.getenv("MAX_LLM_MESSAGES", "40"))
+# La finestra LLM scorre a blocchi di LLM_WINDOW_STEP messaggi: il prefisso della history
+# resta identico (byte per byte) per più turni e il prompt cache del provider può riusarlo
+LLM_WINDOW_STEP = max(1, min(int(os.getenv("LLM_WINDOW_STEP", "10")), MAX_LLM_MESSAGES))
+
+# Cache L1 (per sessione) delle risposte a richieste identiche: voci massime, 0 = disattivata
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "64"))
+
+# Numero massimo di chat elencate nella sidebar (le più recenti)
+CHATS_LIST_LIMIT = int(os.getenv("CHATS_LIST_LIMIT", "50"))
+
+# Ogni chat = metadati piccoli (<id>.meta.json) + transcript (<id>.jsonl, un messaggio per riga)
+_META_SUFFIX = ".meta.json"
+
 # Nome file helper
-def _chat_file_path(chat_id: str) -> Path:
-    return CHATS_DIR / f"{chat_id}.json"
+def _chat_meta_path(chat_id: str) -> Path:
+    return CHATS_DIR / f"{chat_id}{_META_SUFFIX}"
+
+
+def _chat_transcript_path(chat_id: str) -> Path:
+    return CHATS_DIR / f"{chat_id}.jsonl"
+
+
+# ============================== Schema messaggi ==============================
+
+class Msg(TypedDict):
+    """
+    Messaggio della chat (stesse chiavi, nello stesso ordine, per tutti i messaggi
+    creati dalla UI). `_llm_content` è la cache del testo aumentato inviato all'LLM.
+    """
+    id: str
+    role: str
+    content: str
+    think: str | None
+    tools: list | None
+    _llm_content: str | None
 
 
 # ============================== Utility ======================================
 
+# Serializzazione JSON compatta (UTF-8, senza spazi): orjson se disponibile, altrimenti stdlib.
+# Encoder costruiti una volta a import; `_dumps` (str) e `_dumpb` (bytes) senza giri di conversione
+# inutili nel backend stdlib.
+try:
+    import orjson
+
+    _ORJSON_OPTS = orjson.OPT_NON_STR_KEYS
+
+    def _dumpb(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=_ORJSON_OPTS)
+
+    def _dumps(obj: Any) -> str:
+        return orjson.dumps(obj, option=_ORJSON_OPTS).decode("utf-8")
+
+    _loads = orjson.loads
+except ImportError:  # pragma: no cover - fallback senza orjson
+    _dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+    def _dumpb(obj: Any) -> bytes:
+        return _dumps(obj).encode("utf-8")
+
+    _loads = json.loads
+
+
+_TRUNC_LEN = 64
+_TRUNC_HINT = ".....(OUTPUT TRONCATO A 64 CARATTERI, SE SI NECESSITA NUOVAMENTE L'OUTPUT INTEGRALE ALLORA RIESEGUIRE LO STRUMENTO!)"
+
+# Encoder incrementale (iterencode non "one-shot" produce il JSON a pezzi, in modo lazy)
+_trunc_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def _clip_for_head(value: Any, limit: int, budget: List[int]) -> Any:
+    """
+    Copia ridotta di `value` con lo stesso JSON nei primi `limit` caratteri: stringhe
+    tagliate a `limit` (iterencode codifica una stringa tutta in un colpo) e al più
+    `limit` nodi visitati (ognuno produce almeno un carattere).
+    """
+    budget[0] -= 1
+    if isinstance(value, str):
+        return value[:limit]
+    if isinstance(value, dict):
+        out: Dict[Any, Any] = {}
+        for k, v in value.items():
+            if budget[0] <= 0:
+                break
+            if isinstance(k, str) and len(k) > limit:
+                out[k[:limit]] = None  # la chiave da sola riempie la testa
+                break
+            out[k] = _clip_for_head(v, limit, budget)
+        return out
+    if isinstance(value, (list, tuple)):
+        out_list: List[Any] = []
+        for v in value:
+            if budget[0] <= 0:
+                break
+            out_list.append(_clip_for_head(v, limit, budget))
+        return out_list
+    return value
+
+
+def _json_head(value: Any, limit: int) -> str:
+    """Primi `limit` caratteri del JSON di `value`, senza serializzare il resto."""
+    parts: List[str] = []
+    n = 0
+    for chunk in _trunc_encoder.iterencode(_clip_for_head(value, limit, [limit])):
+        parts.append(chunk)
+        n += len(chunk)
+        if n >= limit:
+            break
+    return "".join(parts)[:limit]
+
+
 def _truncate64(value: Any) -> str:
     """Converte in stringa (JSON se dict/list) e tronca a 64 caratteri + hint."""
     try:
-        if isinstance(value, (dict, list, tuple)):
-            s = json.dumps(value, ensure_ascii=False)
+        if isinstance(value, str):
+            s = value[:_TRUNC_LEN]
+        elif isinstance(value, (bytes, bytearray)):
+            s = bytes(value[:_TRUNC_LEN]).decode("utf-8", "replace")
+        elif isinstance(value, (dict, list, tuple)):
+            s = _json_head(value, _TRUNC_LEN)
         else:
-            s = str(value)
+            s = str(value)[:_TRUNC_LEN]
     except Exception:
-        s = repr(value)
-    return s[:64] + ".....(OUTPUT TRONCATO A 64 CARATTERI, SE SI NECESSITA NUOVAMENTE L'OUTPUT INTEGRALE ALLORA RIESEGUIRE LO STRUMENTO!)"
+        s = repr(value)[:_TRUNC_LEN]
+    return s + _TRUNC_HINT
+
+
+def _inputs_json(inputs: Any) -> str:
+    try:
+        return _dumps(inputs)
+    except Exception:
+        return str(inputs)
+
+
+def _precompute_tool_trace(t: Dict[str, Any]) -> None:
+    """Formatta una sola volta la riga di traccia del tool (campo `_trace_line`)."""
+    t["_trace_line"] = (
+        f"[tool] {t.get('name', 'tool')}\n"
+        f"inputs: {_inputs_json(t.get('inputs', {}))}\n"
+        f"output_truncated: {_truncate64(t.get('output', ''))}"
+    )
 
 
 def _hidden_tool_trace_for_msg(msg: Dict[str, Any]) -> str:
     """
     Inserisce una traccia strumenti nel testo (invisibile in UI, visibile all'LLM).
+    Concatena le righe precalcolate a fine tool; le calcola solo per chat salvate in precedenza.
     """
     tools = msg.get("tools") or []
     if not tools:
         return ""
-    lines = ["", "<!-- TOOL_TRACE_START"]
     for t in tools:
-        name = t.get("name", "tool")
-        inputs = t.get("inputs", {})
-        try:
-            inputs_json = json.dumps(inputs, ensure_ascii=False)
-        except Exception:
-            inputs_json = str(inputs)
-        out_trunc = _truncate64(t.get("output", ""))
-        lines.append(f"[tool] {name}")
-        lines.append(f"inputs: {inputs_json}")
-        lines.append(f"output_truncated: {out_trunc}")
-    lines.append("TOOL_TRACE_END -->")
-    return "\n".join(lines)
+        if "_trace_line" not in t:
+            _precompute_tool_trace(t)
+    body = "\n".join(t["_trace_line"] for t in tools)
+    return f"\n<!-- TOOL_TRACE_START\n{body}\nTOOL_TRACE_END -->"
+
+
+# flatten_assistant → {ruolo originale: ruolo inviato all'LLM} (ruoli non standard → 'user')
+_LLM_ROLES: Dict[bool, Dict[str, str]] = {
+    False: {"user": "user", "assistant": "assistant", "system": "system"},
+    True: {"user": "user", "assistant": "user", "system": "system"},
+}
 
 
-def build_llm_history(ui_messages: List[Dict[str, Any]], *, flatten_assistant: bool = False) -> List[Dict[str, Any]]:
+def _llm_content_for_msg(m: Dict[str, Any]) -> str:
     """
-    Ritorna una *copia* della history con il riepilogo strumenti appeso nel testo.
-    Se `flatten_assistant=True`, i messaggi assistant diventano 'user' (legacy). Di default **NO**.
+    Ritorna il contenuto "aumentato" (testo + traccia strumenti) del messaggio.
+    Il risultato viene memorizzato in `m["_llm_content"]`: i messaggi passati non
+    cambiano, quindi json.dumps/concat vengono eseguiti una sola volta per messaggio.
     """
-    llm_hist: List[Dict[str, Any]] = []
-    for m in ui_messages:
-        role = m.get("role", "user")
+    cached = m.get("_llm_content")
+    if cached is None:
         content = m.get("content", "")
         tool_block = _hidden_tool_trace_for_msg(m)
-        content_aug = (content + ("\n" + tool_block if tool_block else "")).strip()
-        if flatten_assistant and role == "assistant":
-            role = "user"
-        # Normalizza minimo indispensabile
-        if role not in ("user", "assistant", "system"):
-            role = "user"
-        llm_hist.append({"role": role, "content": content_aug})
-    return llm_hist
+        cached = (content + ("\n" + tool_block if tool_block else "")).strip()
+        m["_llm_content"] = cached
+    return cached
+
+
+def _iter_llm_entries(ui_messages: List[Dict[str, Any]], flatten_assistant: bool) -> Iterator[Dict[str, str]]:
+    # mappa dei ruoli scelta una volta per chiamata, non per messaggio
+    role_of = _LLM_ROLES[flatten_assistant].get
+    for m in ui_messages:
+        yield {"role": role_of(m.get("role", "user"), "user"), "content": _llm_content_for_msg(m)}
+
+
+def _session_llm_history(*, flatten_assistant: bool = False) -> List[Dict[str, str]]:
+    """
+    History per l'LLM della chat corrente, mantenuta in sessione e aggiornata in modo
+    incrementale: se i messaggi già convertiti sono invariati (stesso ultimo oggetto
+    messaggio) si convertono solo quelli nuovi, altrimenti si ricostruisce da zero.
+    Oltre MAX_LLM_MESSAGES si scartano LLM_WINDOW_STEP messaggi alla volta (prefisso stabile).
+    """
+    messages = st.session_state.messages
+    cache = st.session_state.get("_llm_history_cache")
+    n = cache["count"] if cache else 0
+    if (
+        cache is None
+        or cache["chat_id"] != st.session_state.get("current_chat_id")
+        or cache["flatten"] != flatten_assistant
+        or n > len(messages)
+        or (n and messages[n - 1] is not cache["last"])
+    ):
+        cache = {
+            "chat_id": st.session_state.get("current_chat_id"),
+            "flatten": flatten_assistant,
+            "entries": [],
+            "count": 0,  # messaggi già convertiti (entries ne tiene solo gli ultimi MAX_LLM_MESSAGES)
+            "last": None,
+        }
+        st.session_state._llm_history_cache = cache
+        n = 0
+    if n < len(messages):
+        entries = cache["entries"]
+        entries.extend(_iter_llm_entries(messages[max(n, len(messages) - MAX_LLM_MESSAGES):], flatten_assistant))
+        if len(entries) > MAX_LLM_MESSAGES:
+            del entries[:len(entries) - MAX_LLM_MESSAGES + LLM_WINDOW_STEP]
+        cache["count"] = len(messages)
+        cache["last"] = messages[-1]
+    return list(cache["entries"])
 
 
 def _now_iso() -> str:
@@ -120,6 +324,19 @@ AGENT_OPTIONS = {
     "dss":   {"label": "⚖️ DSS (AHP)",              "help": "Combina KPI ENV+SOC per ranking e score."},
 }
 
+# Badge mostrato sotto il titolo per la modalità attiva
+_MODE_BADGE = {
+    "env": "🌿 **ENV attivo** — Report Ambientale",
+    "social": "👥 **SOCIAL attivo** — Report Sociale",
+    "dss": "⚖️ **DSS attivo** — Analisi AHP",
+}
+
+# Liste/indici del selettore agente calcolati una volta (non ad ogni rerun)
+_AGENT_MODES = tuple(AGENT_OPTIONS.keys())
+_AGENT_INDICES = tuple(range(len(_AGENT_MODES)))
+_MODE_TO_IDX = {m: i for i, m in enumerate(_AGENT_MODES)}
+_AGENT_LABELS = tuple(AGENT_OPTIONS[m]["label"] for m in _AGENT_MODES)
+
 def _ensure_session_defaults():
     # --- preferenze UI ---
     if "messages" not in st.session_state:
@@ -146,7 +363,8 @@ def _initialize_chat_store():
     Carica le chat esistenti dalla cartella. Se non ce ne sono, crea una prima chat vuota.
     Imposta la chat corrente in sessione.
     """
-    chat_ids = _list_chat_ids()
+    _migrate_legacy_chats()
+    chat_ids = _list_chats_by_mtime()
     if not chat_ids:
         chat_id = _create_new_chat_file(default_name=True)
         st.session_state.current_chat_id = chat_id
@@ -157,69 +375,305 @@ def _initialize_chat_store():
         return
 
     # Se ci sono chat: apri la più recente (ordine per updated_at)
-    metas = [_load_chat_meta(cid) for cid in chat_ids]
-    metas_sorted = sorted(
-        [m for m in metas if m],
-        key=lambda x: x.get("updated_at", x.get("created_at", "")),
-        reverse=True
-    )
-    cur = metas_sorted[0]
-    st.session_state.current_chat_id = cur["id"]
-    st.session_state.current_chat_name = cur["name"]
-    st.session_state.current_chat_created_at = cur.get("created_at", _now_iso())
-    st.session_state.messages = _load_chat(cur["id"]).get("messages", [])
+    _switch_chat(_most_recent_chat_id() or _create_new_chat_file(default_name=True))
 
 
-def _list_chat_ids() -> List[str]:
-    return [
-        p.stem for p in CHATS_DIR.glob("*.json")
-        if p.is_file()
-    ]
+def _migrate_legacy_chats():
+    """
+    Converte le chat nel vecchio formato (<id>.json con i messaggi inclusi) nella coppia
+    metadati + transcript JSONL. Il file originale viene rimosso solo dopo che entrambi i
+    nuovi file sono scritti e sincronizzati su disco; le chat non convertibili restano dove
+    sono e vengono segnalate (console + avviso in UI).
+    """
+    failed: List[str] = []
+    for fp in CHATS_DIR.glob("*.json"):
+        if fp.name.endswith(_META_SUFFIX) or not fp.is_file():
+            continue
+        try:
+            with fp.open("rb") as f:
+                data = _loads(f.read())
+            chat_id = data.get("id", fp.stem)
+            messages = data.get("messages", [])
+            _write_transcript(chat_id, messages)
+            _write_chat_meta({
+                "id": chat_id,
+                "name": data.get("name", "Chat"),
+                "created_at": data.get("created_at", _now_iso()),
+                "updated_at": data.get("updated_at", data.get("created_at", _now_iso())),
+                "messages_count": len(messages),
+            })
+            # mtime dei metadati = updated_at originale (ordinamento della lista chat)
+            try:
+                ts = datetime.fromisoformat(data.get("updated_at", "")).timestamp()
+                os.utime(_chat_meta_path(chat_id), (ts, ts))
+            except ValueError:
+                pass
+            _fsync_dir(CHATS_DIR)  # i due os.replace sono persistiti prima di togliere l'originale
+            fp.unlink(missing_ok=True)
+        except Exception as e:
+            print(f"[chats] migrazione di {fp.name} non riuscita, file lasciato invariato: {e!r}")
+            failed.append(fp.name)
+    if failed:
+        st.warning(f"Chat nel vecchio formato non convertite (file lasciati in {CHATS_DIR}): {', '.join(failed)}")
+
+
+def _chat_index() -> Dict[str, str]:
+    """
+    Indice in sessione {chat_id: updated_at}, costruito una volta dai metadati e poi
+    mantenuto da salvataggi/rinomine/eliminazioni (niente riletture per scegliere la chat).
+    """
+    idx = st.session_state.get("chat_index")
+    if idx is None:
+        idx = {}
+        for cid, mtime in _scan_chats():
+            meta = _load_chat_meta(cid, mtime)
+            if meta:
+                idx[meta["id"]] = meta["updated_at"]
+        st.session_state.chat_index = idx
+    return idx
 
 
-def _load_chat_meta(chat_id: str) -> Dict[str, Any] | None:
-    fp = _chat_file_path(chat_id)
+def _most_recent_chat_id() -> str | None:
+    idx = _chat_index()
+    return max(idx, key=idx.get) if idx else None
+
+
+def _scan_chats() -> List[Tuple[str, int]]:
+    """
+    (chat_id, mtime_ns) dei metadati, ordinati per data di modifica (più recente prima).
+    Solo `os.scandir` + stat: nessun file viene aperto.
+    """
+    entries: List[Tuple[int, str]] = []
+    with os.scandir(CHATS_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(_META_SUFFIX) and entry.is_file():
+                entries.append((entry.stat().st_mtime_ns, entry.name[:-len(_META_SUFFIX)]))
+    entries.sort(reverse=True)
+    return [(cid, mtime) for mtime, cid in entries]
+
+
+def _list_chats_by_mtime() -> List[str]:
+    """ID delle chat ordinati per data di modifica dei metadati (più recente prima)."""
+    return [cid for cid, _ in _scan_chats()]
+
+
+def _load_chat_meta(chat_id: str, mtime_ns: int | None = None) -> Dict[str, Any] | None:
+    """
+    Metadati della chat, in cache per (chat_id, mtime): una riscrittura del file cambia
+    la chiave, quindi la cache non restituisce mai metadati superati.
+    """
+    if mtime_ns is None:
+        try:
+            mtime_ns = _chat_meta_path(chat_id).stat().st_mtime_ns
+        except OSError:
+            return None
+    return _load_chat_meta_cached(chat_id, mtime_ns)
+
+
+@st.cache_data(ttl=2.0, show_spinner=False, max_entries=4 * CHATS_LIST_LIMIT)
+def _load_chat_meta_cached(chat_id: str, mtime_ns: int) -> Dict[str, Any] | None:
+    return _read_chat_meta_file(chat_id)
+
+
+def _read_chat_meta_file(chat_id: str) -> Dict[str, Any] | None:
+    """Legge solo il file metadati (nessuna lettura del transcript)."""
+    fp = _chat_meta_path(chat_id)
     if not fp.exists():
         return None
     try:
-        with fp.open("r", encoding="utf-8") as f:
-            data = json.load(f)
+        with fp.open("rb") as f:
+            data = _loads(f.read())
         return {
             "id": data.get("id", chat_id),
             "name": data.get("name", "Chat"),
             "created_at": data.get("created_at", _now_iso()),
             "updated_at": data.get("updated_at", data.get("created_at", _now_iso())),
-            "messages_count": len(data.get("messages", [])),
+            "messages_count": data.get("messages_count", 0),
         }
-    except Exception:
+    except (OSError, ValueError):
         return None
 
 
-def _load_chat(chat_id: str) -> Dict[str, Any]:
-    fp = _chat_file_path(chat_id)
+def _read_transcript(chat_id: str) -> List[Dict[str, Any]]:
+    """Legge il transcript JSONL riga per riga (righe vuote o corrotte vengono saltate)."""
+    fp = _chat_transcript_path(chat_id)
     if not fp.exists():
+        return []
+    messages: List[Dict[str, Any]] = []
+    with fp.open("rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                messages.append(_loads(line))
+            except Exception:
+                continue
+    return messages
+
+
+def _transcript_line(msg: Dict[str, Any]) -> bytes:
+    """
+    Riga JSONL del messaggio. Le chiavi con `_` iniziale sono cache di rendering/LLM
+    (`_llm_content`, `_trace_line` nei tool): restano in memoria, non su file.
+    """
+    out = {k: v for k, v in msg.items() if not k.startswith("_")}
+    if out.get("tools"):
+        out["tools"] = [
+            {k: v for k, v in t.items() if not k.startswith("_")} if isinstance(t, dict) else t
+            for t in out["tools"]
+        ]
+    return _dumpb(out) + b"\n"
+
+
+def _fsync_dir(directory: Path):
+    """fsync della cartella (rende persistenti rename/replace); no-op dove non supportato (Windows)."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_transcript(chat_id: str, messages: List[Dict[str, Any]]):
+    _atomic_write_bytes(_chat_transcript_path(chat_id), b"".join(_transcript_line(m) for m in messages))
+
+
+def _write_chat_meta_file(meta: Dict[str, Any]):
+    """Riscrive i metadati in modo atomico (vedi `_atomic_write_bytes`). Nessun accesso alla sessione."""
+    _atomic_write_bytes(_chat_meta_path(meta["id"]), _dumpb(meta))
+
+
+def _write_chat_meta(meta: Dict[str, Any]):
+    _write_chat_meta_file(meta)
+    _touch_chat_index(meta["id"], meta.get("updated_at", ""))
+
+
+def _touch_chat_index(chat_id: str, updated_at: str):
+    idx = st.session_state.get("chat_index")
+    if idx is not None:
+        idx[chat_id] = updated_at
+
+
+# I/O delle chat fuori dal thread del rerun: un solo worker, quindi le scritture restano
+# nell'ordine di sottomissione. I task ricevono solo dati già pronti (bytes, dict copiati):
+# niente accessi a st.session_state dal worker.
+_io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-io")
+
+
+def _submit_chat_io(fn, *args):
+    futures = _reap_chat_io(st.session_state.get("_io_futures", []))
+    futures.append(_io_executor.submit(fn, *args))
+    st.session_state._io_futures = futures
+
+
+def _reap_chat_io(futures: list, wait: bool = False) -> list:
+    """
+    Ritorna le scritture ancora in corso (con `wait`, le attende tutte). Gli errori di
+    quelle concluse vanno in `_io_errors` e sono mostrati al prossimo rerun
+    (`_show_chat_io_errors`): non fanno fallire un'azione successiva non correlata.
+    """
+    pending = []
+    for f in futures:
+        if not wait and not f.done():
+            pending.append(f)
+            continue
+        exc = f.exception()  # con wait: blocca fino alla fine della scrittura
+        if exc is not None:
+            st.session_state.setdefault("_io_errors", []).append(f"{type(exc).__name__}: {exc}")
+    return pending
+
+
+def _wait_for_chat_io():
+    """Attende le scritture in coda della sessione (prima di rileggere i file); gli errori non vengono rilanciati."""
+    _reap_chat_io(st.session_state.pop("_io_futures", []), wait=True)
+
+
+def _show_chat_io_errors():
+    errors = st.session_state.pop("_io_errors", None)
+    if errors:
+        st.warning("Salvataggio della chat non riuscito: " + "; ".join(errors))
+
+
+def _append_line_to_transcript(chat_id: str, line: bytes, meta_defaults: Dict[str, Any], updated_at: str):
+    """
+    Persistenza append-only: una riga JSONL per messaggio (O(1) per turno) e
+    aggiornamento dei soli metadati (updated_at, messages_count). Eseguita sul worker I/O.
+    """
+    with _chat_transcript_path(chat_id).open("ab") as f:
+        # lock esclusivo: più sessioni Streamlit sulla stessa chat non intercalano le righe
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        f.write(line)
+        f.flush()
+    meta = _read_chat_meta_file(chat_id) or meta_defaults
+    meta["updated_at"] = updated_at
+    meta["messages_count"] = meta.get("messages_count", 0) + 1
+    _write_chat_meta_file(meta)
+
+
+def _append_message_to_transcript(chat_id: str, msg: Dict[str, Any]):
+    """Serializza subito il messaggio (snapshot) e ne accoda la scrittura al worker I/O."""
+    updated_at = _now_iso()
+    meta_defaults = {
+        "id": chat_id,
+        "name": st.session_state.get("current_chat_name", "Chat"),
+        "created_at": st.session_state.get("current_chat_created_at", updated_at),
+        "messages_count": 0,
+    }
+    _submit_chat_io(_append_line_to_transcript, chat_id, _transcript_line(msg), meta_defaults, updated_at)
+    _touch_chat_index(chat_id, updated_at)
+
+
+def _legacy_message_id(chat_id: str, index: int) -> str:
+    """ID stabile per i messaggi salvati senza `id`: derivato da chat e posizione nel transcript."""
+    return hashlib.sha256(f"{chat_id}:{index}".encode("utf-8")).hexdigest()[:12]
+
+
+def _load_chat(chat_id: str) -> Dict[str, Any]:
+    _wait_for_chat_io()
+    meta = _load_chat_meta(chat_id)
+    if meta is None:
         return {"id": chat_id, "name": "Chat", "created_at": _now_iso(), "updated_at": _now_iso(), "messages": []}
-    with fp.open("r", encoding="utf-8") as f:
-        return json.load(f)
+    messages = _read_transcript(chat_id)
+    missing = [i for i, m in enumerate(messages) if not m.get("id")]
+    if missing:
+        # chat salvate prima degli ID: assegnati una volta e persistiti (chiavi widget stabili)
+        for i in missing:
+            messages[i]["id"] = _legacy_message_id(chat_id, i)
+        _write_transcript(chat_id, messages)
+    meta["messages"] = messages
+    return meta
+
+
+def _save_current_chat_files(chat_id: str, transcript: bytes, meta: Dict[str, Any]):
+    CHATS_DIR.mkdir(parents=True, exist_ok=True)
+    _atomic_write_bytes(_chat_transcript_path(chat_id), transcript)
+    _write_chat_meta_file(meta)
 
 
 def _save_current_chat():
     """
-    Salva la chat corrente su file JSON. Viene chiamato automaticamente al termine
-    dell'aggiunta di un messaggio utente o assistant.
+    Riscrive per intero la chat corrente (metadati + transcript), es. dopo "Svuota chat".
+    I nuovi messaggi vengono invece accodati da `_append_message_to_transcript`.
+    Snapshot serializzato qui, scrittura (fsync) sul worker I/O.
     """
     chat_id = st.session_state.current_chat_id
-    data = {
+    messages = st.session_state.messages
+    meta = {
         "id": chat_id,
         "name": st.session_state.get("current_chat_name", "Chat"),
         "created_at": st.session_state.get("current_chat_created_at", _now_iso()),
         "updated_at": _now_iso(),
-        "messages": st.session_state.messages,
+        "messages_count": len(messages),
     }
-    fp = _chat_file_path(chat_id)
-    fp.parent.mkdir(parents=True, exist_ok=True)
-    with fp.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    _submit_chat_io(_save_current_chat_files, chat_id, b"".join(_transcript_line(m) for m in messages), meta)
+    _touch_chat_index(chat_id, meta["updated_at"])
 
 
 def _create_new_chat_file(default_name: bool = False) -> str:
@@ -229,15 +683,14 @@ def _create_new_chat_file(default_name: bool = False) -> str:
     chat_id = uuid.uuid4().hex[:12]
     now = _now_iso()
     name = f"Nuova chat ({now.split('T')[0]})" if default_name else "Nuova chat"
-    data = {
+    _write_transcript(chat_id, [])
+    _write_chat_meta({
         "id": chat_id,
         "name": name,
         "created_at": now,
         "updated_at": now,
-        "messages": [],
-    }
-    with _chat_file_path(chat_id).open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        "messages_count": 0,
+    })
     return chat_id
 
 
@@ -250,50 +703,46 @@ def _switch_chat(chat_id: str):
     st.session_state.current_chat_name = chat.get("name", "Chat")
     st.session_state.current_chat_created_at = chat.get("created_at", _now_iso())
     st.session_state.messages = chat.get("messages", [])
+    st.session_state.visible_count = HISTORY_PAGE_SIZE
 
 
 def _rename_chat(chat_id: str, new_name: str):
     """
-    Rinomina una chat e salva su file. Se è la chat corrente, aggiorna la sessione.
+    Rinomina una chat (riscrive solo i metadati). Se è la chat corrente, aggiorna la sessione.
     """
-    chat = _load_chat(chat_id)
-    chat["name"] = new_name.strip() or "Chat"
-    chat["updated_at"] = _now_iso()
-    with _chat_file_path(chat_id).open("w", encoding="utf-8") as f:
-        json.dump(chat, f, ensure_ascii=False, indent=2)
+    _wait_for_chat_io()
+    meta = _load_chat_meta(chat_id)
+    if meta is None:
+        return
+    meta["name"] = new_name.strip() or "Chat"
+    meta["updated_at"] = _now_iso()
+    _write_chat_meta(meta)
     if chat_id == st.session_state.current_chat_id:
-        st.session_state.current_chat_name = chat["name"]
+        st.session_state.current_chat_name = meta["name"]
 
 
 def _delete_chat(chat_id: str):
     """
-    Elimina il file della chat. Se è la chat corrente, passa a un'altra chat o ne crea una nuova.
+    Elimina i file della chat. Se è la chat corrente, passa a un'altra chat o ne crea una nuova.
     """
-    fp = _chat_file_path(chat_id)
-    if fp.exists():
-        fp.unlink(missing_ok=True)
+    _wait_for_chat_io()
+    _chat_meta_path(chat_id).unlink(missing_ok=True)
+    _chat_transcript_path(chat_id).unlink(missing_ok=True)
+    _chat_index().pop(chat_id, None)
 
-    # Se ho eliminato la corrente → scegli un'altra
+    # Se ho eliminato la corrente → apri la più recente (o creane una nuova)
     if chat_id == st.session_state.current_chat_id:
-        ids = _list_chat_ids()
-        if not ids:
-            new_id = _create_new_chat_file(default_name=True)
-            _switch_chat(new_id)
-        else:
-            # Apri la più recente
-            metas = [_load_chat_meta(cid) for cid in ids]
-            metas_sorted = sorted(
-                [m for m in metas if m],
-                key=lambda x: x.get("updated_at", x.get("created_at", "")),
-                reverse=True
-            )
-            _switch_chat(metas_sorted[0]["id"])
+        next_id = _most_recent_chat_id() or _create_new_chat_file(default_name=True)
+        _switch_chat(next_id)
 
 
 # ============================== Rendering / UI ===============================
 
 def render_chat_page():
     _ensure_session_defaults()
+    # errori delle scritture in background (turni precedenti): avviso, non eccezione
+    st.session_state._io_futures = _reap_chat_io(st.session_state.get("_io_futures", []))
+    _show_chat_io_errors()
 
     # ---- CSS leggero per lista chat (sidebar) ----
     st.markdown(
@@ -327,19 +776,7 @@ def render_chat_page():
     # ------------------------- Sidebar: selezione agente + opzioni + chats ----
     st.sidebar.markdown("---")
     with st.sidebar.expander("Selezione agente", expanded=True):
-        modes = list(AGENT_OPTIONS.keys())
-        current_idx = modes.index(st.session_state.agent_mode) if st.session_state.agent_mode in modes else 0
-
-        new_idx = st.selectbox(
-            "Modalità agente",
-            options=list(range(len(modes))),
-            index=current_idx,
-            format_func=lambda i: AGENT_OPTIONS[modes[i]]["label"],
-            help=AGENT_OPTIONS[modes[current_idx]]["help"],
-            key="agent_mode_selectbox",
-        )
-        st.session_state.agent_mode = modes[new_idx]
-        st.caption(f"Modalità attiva: **{AGENT_OPTIONS[st.session_state.agent_mode]['label']}**")
+        _render_agent_selector()
 
     with st.sidebar.expander("⚙️ Opzioni Chat", expanded=True):
         st.caption("Ollama OpenAI-compat: usa ENV OPENAI_BASE_URL / OPENAI_API_KEY")
@@ -359,7 +796,7 @@ def render_chat_page():
         cols = st.columns(2)
         with cols[0]:
             if st.button("🧹 Svuota chat"):
-                st.session_state.messages = []
+                st.session_state.messages.clear()  # stessa lista: niente nuova allocazione
                 _save_current_chat()
                 st.rerun()
         with cols[1]:
@@ -377,16 +814,10 @@ def render_chat_page():
         st.rerun()
 
     # Badge modalità corrente sotto il titolo
-    _mode_badge = {
-        "env": "🌿 **ENV attivo** — Report Ambientale",
-        "social": "👥 **SOCIAL attivo** — Report Sociale",
-        "dss": "⚖️ **DSS attivo** — Analisi AHP",
-    }
-    st.markdown(_mode_badge.get(st.session_state.agent_mode, ""))
+    st.markdown(_MODE_BADGE.get(st.session_state.agent_mode, ""))
 
     # ------------------------- Rendering storico messaggi ---------------------
-    for m in st.session_state.messages:
-        _render_message(m)
+    _render_history()
 
     # ------------------------- Input utente -----------------------------------
     user_text = st.chat_input("Scrivi un messaggio per l’agente selezionato…")
@@ -394,41 +825,55 @@ def render_chat_page():
         # Mostra subito il messaggio utente e persistilo
         with st.chat_message("user"):
             st.markdown(user_text)
-        _append_user_message(user_text)
-        _save_current_chat()  # salvataggio automatico dopo messaggio utente
+        _append_user_message(user_text)  # salvataggio automatico (append su transcript)
 
         # Costruisci la history *per l'LLM*, con i tool inseriti nel testo (nascosti alla UI)
-        llm_history = build_llm_history(st.session_state.messages, flatten_assistant=False)
-
-        # Esegui core e streamma la risposta (con modalità selezionata)
-        result = asyncio.run(_run_agent_and_stream(llm_history, user_text, st.session_state.agent_mode))
+        # (lista: event_stream la scorre più volte; solo i messaggi nuovi vengono convertiti)
+        llm_history = _session_llm_history(flatten_assistant=False)
+
+        # Stessa domanda con la stessa history/modello/modalità: risposta dalla cache L1 di sessione
+        cache_key = _response_cache_key(llm_history, user_text, st.session_state.agent_mode)
+        result = _cached_response(cache_key)
+        if result is not None:
+            _render_message({"role": "assistant", "content": result["text"],
+                             "think": result["think"], "tools": result["tools"]})
+        else:
+            # Esegui core e streamma la risposta (con modalità selezionata)
+            result = _run_agent_and_stream(llm_history, user_text, st.session_state.agent_mode)
+            if not result["error"]:
+                _store_response(cache_key, result)
 
         # Persisti risposta assistant con Thinking/Tools salvati
         _append_assistant_message(
             content=result["text"],
             think=result["think"],
             tools=result["tools"],
-        )
-        _save_current_chat()  # salvataggio automatico dopo messaggio assistant
+        )  # salvataggio automatico (append su transcript)
+        # Rerun completo: il turno appena streammato (fuori dal fragment) entra nello storico,
+        # così un rerun del solo fragment (es. "Carica messaggi precedenti") non lo mostra due volte
+        st.rerun()
 
 
 # ===================== UI Helpers: Chats Manager =============================
 
+@st.fragment
 def _render_chats_manager():
     """
     Expander in sidebar che mostra lista scrollabile delle chat, con azioni:
     - Apri
     - Rinomina
     - Elimina
+    In un fragment: entrare/uscire dalla modalità rinomina riesegue solo questa lista;
+    le azioni che cambiano chat o file rieseguono l'intera pagina.
     """
-    chat_ids = _list_chat_ids()
-    metas = [_load_chat_meta(cid) for cid in chat_ids]
-    metas = [m for m in metas if m]
-
-    # Ordina per aggiornamento (desc)
-    metas_sorted = sorted(metas, key=lambda x: x.get("updated_at", x.get("created_at", "")), reverse=True)
-
-    st.caption(f"Chat salvate: **{len(metas_sorted)}**")
+    # Ordine per mtime dei metadati (≈ updated_at); metadati letti solo per le chat mostrate
+    chats = _scan_chats()
+    chat_ids = [cid for cid, _ in chats]
+    metas = [_load_chat_meta(cid, mtime) for cid, mtime in chats[:CHATS_LIST_LIMIT]]
+    metas_sorted = [m for m in metas if m]
+
+    st.caption(f"Chat salvate: **{len(chat_ids)}**"
+               + (f" (mostrate le {CHATS_LIST_LIMIT} più recenti)" if len(chat_ids) > CHATS_LIST_LIMIT else ""))
     list_box = st.container()
     with list_box:
         st.markdown('<div class="chat-list-box">', unsafe_allow_html=True)
@@ -450,7 +895,7 @@ def _render_chats_manager():
             with cols[1]:
                 if st.button("✏️", key=f"rn_{cid}", help="Rinomina"):
                     st.session_state.renaming_chat_id = cid
-                    st.rerun()
+                    st.rerun(scope="fragment")
 
             with cols[2]:
                 if st.button("🗑️", key=f"del_{cid}", help="Elimina definitivamente"):
@@ -476,7 +921,7 @@ def _render_chats_manager():
                 with rcols[2]:
                     if st.button("✖️", key=f"cancel_{cid}", help="Annulla"):
                         st.session_state.renaming_chat_id = None
-                        st.rerun()
+                        st.rerun(scope="fragment")
 
             st.markdown("---")
 
@@ -485,22 +930,75 @@ def _render_chats_manager():
 
 def _duplicate_chat(chat_id: str):
     """
-    Duplica una chat su un nuovo file, con suffix timestamp.
+    Duplica una chat su nuovi file, con suffix timestamp.
     """
     chat = _load_chat(chat_id)
     new_id = uuid.uuid4().hex[:12]
     now = _now_iso()
-    chat["id"] = new_id
-    chat["name"] = f"{chat.get('name','Chat')} (copia {now.split('T')[0]})"
-    chat["created_at"] = now
-    chat["updated_at"] = now
-    with _chat_file_path(new_id).open("w", encoding="utf-8") as f:
-        json.dump(chat, f, ensure_ascii=False, indent=2)
+    messages = chat.get("messages", [])
+    _write_transcript(new_id, messages)
+    _write_chat_meta({
+        "id": new_id,
+        "name": f"{chat.get('name','Chat')} (copia {now.split('T')[0]})",
+        "created_at": now,
+        "updated_at": now,
+        "messages_count": len(messages),
+    })
 
 
 # ===================== Helpers interni (solo per questa pagina) ==============
 
-def _render_message(m: Dict[str, Any]):
+# Throttling dello streaming: ri-renderizza al massimo ~25 volte/s o ogni N caratteri
+# (sovrascrivibili via ENV per tarare latenza percepita vs. numero di render)
+_FLUSH_INTERVAL_S = float(os.getenv("STREAM_FLUSH_INTERVAL_S", "0.04"))
+_FLUSH_MIN_CHARS = int(os.getenv("STREAM_FLUSH_MIN_CHARS", "64"))
+_FLUSH_BOUNDARIES = (".", "!", "?", "\n")
+
+# Numero di messaggi assistant recenti con expander strumenti sempre costruiti
+TOOLS_VISIBLE_WINDOW = 10
+
+# Messaggi dello storico renderizzati per "pagina" (i precedenti su richiesta)
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "40"))
+
+@st.fragment
+def _render_agent_selector():
+    """
+    Selettore agente isolato in un fragment: il cambio modalità riesegue solo questo
+    blocco (niente rerender dello storico). Il badge sotto il titolo si aggiorna al
+    prossimo rerun completo (es. invio messaggio).
+    """
+    current_idx = _MODE_TO_IDX.get(st.session_state.agent_mode, 0)
+
+    new_idx = st.selectbox(
+        "Modalità agente",
+        options=_AGENT_INDICES,
+        index=current_idx,
+        format_func=_AGENT_LABELS.__getitem__,
+        help=AGENT_OPTIONS[_AGENT_MODES[current_idx]]["help"],
+        key="agent_mode_selectbox",
+    )
+    st.session_state.agent_mode = _AGENT_MODES[new_idx]
+    st.caption(f"Modalità attiva: **{_AGENT_LABELS[new_idx]}**")
+
+
+@st.fragment
+def _render_history():
+    """Storico messaggi in un fragment separato dalle interazioni della sidebar."""
+    messages = st.session_state.messages
+    # Solo gli ultimi `visible_count` messaggi: i precedenti si caricano a pagine
+    visible = st.session_state.setdefault("visible_count", HISTORY_PAGE_SIZE)
+    start = max(0, len(messages) - visible)
+    if start and st.button("⬆️ Carica messaggi precedenti", key="load_earlier_messages"):
+        st.session_state.visible_count = visible + HISTORY_PAGE_SIZE
+        st.rerun(scope="fragment")
+    # Indice del primo messaggio assistant che rientra negli ultimi TOOLS_VISIBLE_WINDOW
+    assistant_idx = [i for i in range(start, len(messages)) if messages[i]["role"] == "assistant"]
+    first_inline = assistant_idx[-TOOLS_VISIBLE_WINDOW] if len(assistant_idx) >= TOOLS_VISIBLE_WINDOW else 0
+    for i in range(start, len(messages)):
+        _render_message(messages[i], tools_inline=i >= first_inline)
+
+
+def _render_message(m: Dict[str, Any], tools_inline: bool = True):
     with st.chat_message(m["role"]):
         st.markdown(m.get("content", ""))
 
@@ -510,8 +1008,14 @@ def _render_message(m: Dict[str, Any]):
                 with st.expander("🧠 Thinking", expanded=False):
                     st.markdown(m["think"])
 
-            # Tool persistiti
+            # Tool persistiti (per i messaggi vecchi solo su richiesta)
             if st.session_state.get("show_tools") and m.get("tools"):
+                if not tools_inline:
+                    key = f"expand_tools_{m['id']}"
+                    if not st.session_state.get(key):
+                        if not st.button(f"🔧 {len(m['tools'])} strumenti usati (clicca per caricare)", key=f"btn_{key}"):
+                            return
+                        st.session_state[key] = True
                 for t in m["tools"]:
                     exp = st.expander(
                         f"🔧 Eseguendo strumento: {t.get('name', 'tool')}",
@@ -525,189 +1029,405 @@ def _render_message(m: Dict[str, Any]):
 
 
 def _append_user_message(content: str):
-    st.session_state.messages.append(
-        {"role": "user", "content": content, "think": None, "tools": None}
-    )
+    msg = Msg(id=uuid.uuid4().hex[:12], role="user", content=content, think=None, tools=None, _llm_content=None)
+    st.session_state.messages.append(msg)
+    _append_message_to_transcript(st.session_state.current_chat_id, msg)
 
 
 def _append_assistant_message(content: str, think: str | None, tools: list | None):
-    st.session_state.messages.append(
-        {"role": "assistant", "content": content, "think": think, "tools": tools}
-    )
+    msg = Msg(id=uuid.uuid4().hex[:12], role="assistant", content=content, think=think, tools=tools, _llm_content=None)
+    st.session_state.messages.append(msg)
+    _append_message_to_transcript(st.session_state.current_chat_id, msg)
+    excess = len(st.session_state.messages) - MAX_UI_MESSAGES
+    if excess > 0:
+        # taglio sul posto + count riallineato: la history LLM in sessione resta incrementale
+        del st.session_state.messages[:excess]
+        cache = st.session_state.get("_llm_history_cache")
+        if cache is not None:
+            if cache["count"] > excess:
+                cache["count"] -= excess
+            else:
+                st.session_state.pop("_llm_history_cache")
+
+
+def _response_cache_key(llm_history: List[Dict[str, str]], user_text: str, mode: str) -> str:
+    """
+    sha256 di (modello, modalità, testo utente, history inviata all'LLM, versione dei
+    dataset dei tool): dopo un salvataggio da un editor la risposta non viene riusata.
+    """
+    h = hashlib.sha256()
+    for part in (MODEL, mode, user_text):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    for path in _tool_dataset_paths():
+        try:
+            s = path.stat()
+            h.update(f"{s.st_mtime_ns}:{s.st_size}".encode("ascii"))
+        except OSError:
+            h.update(b"-")
+        h.update(b"\x00")
+    for e in llm_history:
+        h.update(e["role"].encode("utf-8"))
+        h.update(b"\x01")
+        h.update(e["content"].encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def _cached_response(key: str) -> Dict[str, Any] | None:
+    cache = st.session_state.get("_response_cache")
+    if not cache or key not in cache:
+        return None
+    cache.move_to_end(key)
+    # copia: il messaggio che la riusa non condivide la lista tools con la cache
+    return dict(cache[key], tools=copy.deepcopy(cache[key]["tools"]))
+
+
+def _store_response(key: str, result: Dict[str, Any]):
+    """Memorizza la risposta nella cache LRU di sessione (max RESPONSE_CACHE_SIZE voci)."""
+    if RESPONSE_CACHE_SIZE <= 0 or not result.get("text"):
+        return
+    cache = st.session_state.get("_response_cache")
+    if cache is None:
+        cache = st.session_state._response_cache = OrderedDict()
+    cache[key] = dict(result, tools=copy.deepcopy(result["tools"]))
+    cache.move_to_end(key)
+    while len(cache) > RESPONSE_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+_THINK_OPEN = "<think>"
+_THINK_CLOSE = "</think>"
+_THINK_TAG_RE = re.compile(r"</?think>")
+# Tag atteso e caratteri da trattenere (len(tag) - 1) indicizzati per stato: [fuori, dentro] il think
+_THINK_EXPECTED = (_THINK_OPEN, _THINK_CLOSE)
+_THINK_LOOKBACK = (len(_THINK_OPEN) - 1, len(_THINK_CLOSE) - 1)
+
+
+def _partial_tag_len(text: str, tag: str, lookback: int | None = None) -> int:
+    """Lunghezza del suffisso di `text` che potrebbe essere l'inizio di `tag` (0 se nessuno)."""
+    # un inizio di tag comincia con "<" negli ultimi len(tag)-1 caratteri: un solo rfind, niente slice in loop
+    if lookback is None:
+        lookback = len(tag) - 1
+    i = text.rfind("<", max(0, len(text) - lookback))
+    if i < 0 or not tag.startswith(text[i:]):
+        return 0
+    return len(text) - i
 
 
 def _stream_split_think(chunk: str, state: Dict[str, Any]) -> Tuple[str, str]:
     """
     Parser in streaming per separare testo vs <think>...</think> (token-safe).
+    Scansione singola con una regex compilata (`finditer` in C); un tag spezzato tra due chunk viene
+    trattenuto in `state["buffer"]` fino al chunk successivo.
     Ritorna (visible_delta, think_delta).
     """
-    visible_delta = ""
-    think_delta = ""
-    i = 0
+    buffered = state.get("buffer")
+    # caso tipico: nessun "<" e nessun tag in sospeso → niente regex, il chunk va tutto da un lato
+    if not buffered and "<" not in chunk:
+        return ("", chunk) if state["in_think"] else (chunk, "")
+    rest = buffered + chunk if buffered else chunk
+    in_think = state["in_think"]
+    parts: Tuple[List[str], List[str]] = ([], [])  # (visibile, think)
+
+    last = 0
+    for m in _THINK_TAG_RE.finditer(rest):
+        # conta solo il tag atteso nello stato corrente (un </think> fuori dal think è testo)
+        if m[0] != _THINK_EXPECTED[in_think]:
+            continue
+        parts[in_think].append(rest[last:m.start()])
+        in_think = not in_think
+        last = m.end()
+    rest = rest[last:]
+
+    n = len(rest)
+    keep = _partial_tag_len(rest, _THINK_EXPECTED[in_think], _THINK_LOOKBACK[in_think])
+    parts[in_think].append(rest[:n - keep])
+
+    state["buffer"] = rest[n - keep:]
+    state["in_think"] = in_think
+    return "".join(parts[0]), "".join(parts[1])
+
+
+_UI_START, _UI_END = 1, 2  # operazioni UI in coda per un tool (bitmask)
+
+
+@dataclass
+class _StreamCtx:
+    """Stato di una risposta in streaming (placeholder UI, testo accumulato, tool)."""
+    show_thinking: bool
+    show_tools: bool
+    text_box: Any
+    text_ph: Any
+    # Testo accumulato a pezzi: join solo quando il throttling decide di ri-renderizzare
+    final_parts: List[str] = field(default_factory=list)
+    think_parts: List[str] = field(default_factory=list)
+    # Paragrafi già resi in blocchi statici: fuori da final_parts/think_parts, non si ri-concatenano più
+    done_parts: List[str] = field(default_factory=list)
+    think_done_parts: List[str] = field(default_factory=list)
+    think_box: Any = None
+    think_ph: Any = None
+    tools_container: Any = None
+    tool_calls: List[Dict[str, Any]] = field(default_factory=list)  # [{name, inputs, output}...]
+    tool_placeholders: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    parse_state: Dict[str, Any] = field(default_factory=lambda: {"in_think": False})
+    failed: bool = False  # lo stream ha emesso almeno un evento "error"
+    # Aggiornamenti UI dei tool in coda, per run_id (ordine di inserimento) → _UI_START | _UI_END;
+    # più eventi dello stesso tool tra due flush diventano un solo aggiornamento
+    ui_ops: Dict[str, int] = field(default_factory=dict)
+    # Throttling dei render: {"text"|"think"|"ui": [ultimo_flush_monotonic, caratteri_pendenti]}
+    flush_state: Dict[str, List[float]] = field(
+        default_factory=lambda: {k: [time.monotonic(), 0] for k in ("text", "think", "ui")}
+    )
 
-    while i < len(chunk):
-        if not state["in_think"]:
-            start = chunk.find("<think>", i)
-            if start == -1:
-                visible_delta += chunk[i:]
-                break
-            visible_delta += chunk[i:start]
-            i = start + len("<think>")
-            state["in_think"] = True
-        else:
-            end = chunk.find("</think>", i)
-            if end == -1:
-                think_delta += chunk[i:]
-                break
-            think_delta += chunk[i:end]
-            i = end + len("</think>")
-            state["in_think"] = False
+    def due(self, which: str, delta: str, force: bool = False) -> bool:
+        """True se è il momento di ri-renderizzare il placeholder `which`."""
+        fs = self.flush_state[which]
+        fs[1] += len(delta)
+        now = time.monotonic()
+        if (force or fs[1] >= _FLUSH_MIN_CHARS or now - fs[0] >= _FLUSH_INTERVAL_S
+                or delta.endswith(_FLUSH_BOUNDARIES)):
+            fs[0], fs[1] = now, 0
+            return True
+        return False
+
+    @staticmethod
+    def _joined(parts: List[str]) -> str:
+        """Concatena i pezzi e li compatta in uno solo (i join successivi ripartono da lì)."""
+        text = "".join(parts)
+        parts[:] = [text]
+        return text
+
+    @property
+    def final_text(self) -> str:
+        return "".join(self.done_parts) + self._joined(self.final_parts)
+
+    @property
+    def think_text(self) -> str:
+        return "".join(self.think_done_parts) + self._joined(self.think_parts)
+
+    def _render_tail(self, parts: List[str], done: List[str], box: Any, ph: Any) -> Any:
+        """
+        Rendering a blocchi: i paragrafi completati diventano elementi statici e solo la
+        coda (paragrafo in corso) viene ri-renderizzata ad ogni flush. Ritorna il
+        placeholder della coda (nuovo se un paragrafo è stato chiuso).
+        """
+        tail = self._joined(parts)
+        cut = tail.rfind("\n\n")
+        # non spezzare un blocco ``` ancora aperto
+        if cut > 0 and tail.count("```", 0, cut) % 2 == 0:
+            ph.markdown(tail[:cut])
+            ph = box.empty()
+            done.append(tail[:cut + 2])
+            tail = tail[cut + 2:]
+            parts[:] = [tail]
+        ph.markdown(tail)
+        return ph
+
+    def render_text(self):
+        self.text_ph = self._render_tail(self.final_parts, self.done_parts, self.text_box, self.text_ph)
+
+    def flush_think(self, delta: str = "", force: bool = False):
+        if not self.show_thinking:
+            return
+        if self.think_ph is None:
+            self.think_box = st.expander("🧠 Thinking", expanded=False)
+            self.think_ph = self.think_box.empty()
+        if self.due("think", delta, force):
+            self.think_ph = self._render_tail(self.think_parts, self.think_done_parts, self.think_box, self.think_ph)
+
+    def tools_box(self):
+        if self.tools_container is None:
+            self.tools_container = st.container()
+        return self.tools_container
+
+    def ensure_tool_placeholder(self, trun: str, tname: str, tinp: Any) -> Dict[str, Any]:
+        """Registra il tool in tool_calls; expander e placeholder I/O vengono creati in `drain_ui`."""
+        self.tool_calls.append({"name": tname, "inputs": tinp, "output": None})
+        ph = {"idx": len(self.tool_calls) - 1, "input_ph": None, "output_ph": None}
+        self.tool_placeholders[trun] = ph
+        if self.show_tools:
+            self.ui_ops[trun] = self.ui_ops.get(trun, 0) | _UI_START
+        return ph
+
+    def drain_ui(self):
+        """Esegue in un solo passaggio le operazioni UI dei tool accumulate."""
+        for trun, ops in self.ui_ops.items():
+            ph = self.tool_placeholders[trun]
+            tool = self.tool_calls[ph["idx"]]
+            if ops & _UI_START:
+                with self.tools_box().expander(f"🔧 Eseguendo strumento: {tool['name']}", expanded=False):
+                    st.markdown("**Input**")
+                    ph["input_ph"] = st.empty()
+                    st.markdown("**Output**")
+                    ph["output_ph"] = st.empty()
+                ph["input_ph"].code(tool["inputs"], language="json")
+            if ops & _UI_END and ph["output_ph"] is not None:
+                ph["output_ph"].code(tool["output"], language="json")
+        self.ui_ops.clear()
+
+
+# Handler per tipo di evento: ritornano True per interrompere lo stream
+
+def _handle_token(ev: Dict[str, Any], ctx: _StreamCtx) -> bool:
+    chunk = ev.get("text", "")
+
+    # ====== NUOVO: stream reasoning separato quando il core lo fornisce ======
+    if ev.get("kind") == "reasoning":
+        # Accumula sempre; mostra solo se il toggle è attivo (non mischiare nel testo visibile)
+        ctx.think_parts.append(chunk)
+        ctx.flush_think(chunk)
+        return False
+
+    # ====== OLD/FALLBACK: parsing dei tag <think> dentro il content assistant ======
+    vis, th = _stream_split_think(chunk, ctx.parse_state)
+
+    # testo visibile
+    if vis:
+        ctx.final_parts.append(vis)
+        if ctx.due("text", vis):
+            ctx.render_text()
+
+    # thinking estratto dai tag <think>...</think> (anche mentre siamo *ancora* dentro <think>)
+    if th:
+        ctx.think_parts.append(th)
+        ctx.flush_think(th)
+    return False
+
+
+def _handle_tool_start(ev: Dict[str, Any], ctx: _StreamCtx) -> bool:
+    tname = ev.get("name", "tool")
+    trun  = ev.get("run_id") or f"run_{len(ctx.tool_calls)}"
+    tinp  = ev.get("inputs") or ev.get("input") or {}
+    # un tool può durare secondi: il testo ancora trattenuto dal throttling va mostrato ora
+    if ctx.flush_state["text"][1] and ctx.due("text", "", force=True):
+        ctx.render_text()
+    ctx.ensure_tool_placeholder(trun, tname, tinp)
+    return False
+
+
+def _handle_tool_end(ev: Dict[str, Any], ctx: _StreamCtx) -> bool:
+    trun = ev.get("run_id")
+    tout = ev.get("output", "")
+
+    ph = ctx.tool_placeholders.get(trun) or ctx.ensure_tool_placeholder(
+        trun, ev.get("name", "tool"), ev.get("inputs") or ev.get("input") or {}
+    )
+    tool = ctx.tool_calls[ph["idx"]]
+    tool["output"] = tout
+    _precompute_tool_trace(tool)
+    if ctx.show_tools:
+        ctx.ui_ops[trun] = ctx.ui_ops.get(trun, 0) | _UI_END
+    return False
+
+
+def _handle_error(ev: Dict[str, Any], ctx: _StreamCtx) -> bool:
+    err = f"**[Errore]** {ev.get('message')}"
+    ctx.failed = True
+    ctx.final_parts.append("\n\n" + err)
+    ctx.due("text", err, force=True)
+    ctx.render_text()
+    if ctx.show_tools:
+        ctx.tools_box().error(err)
+    return False
+
+
+def _handle_done(ev: Dict[str, Any], ctx: _StreamCtx) -> bool:
+    return True
+
+
+_HANDLERS = {
+    "token": _handle_token,
+    "tool_start": _handle_tool_start,
+    "tool_end": _handle_tool_end,
+    "error": _handle_error,
+    "done": _handle_done,
+}
 
-    return visible_delta, think_delta
+
+_STREAM_END = object()  # sentinella: event_stream esaurito
+
+
+async def _pump_events(user_text: str, ui_history: List[Dict[str, Any]], mode: str, q: queue.SimpleQueue):
+    """Consuma event_stream(...) sul loop di processo e inoltra gli eventi al thread dello script."""
+    try:
+        async for ev in event_stream(user_text, ui_history, mode=mode):
+            q.put(ev)
+    except Exception as e:
+        q.put({"type": "error", "message": str(e)})
+    finally:
+        q.put(_STREAM_END)
 
 
-async def _run_agent_and_stream(ui_history: List[Dict[str, Any]], user_text: str, mode: str) -> Dict[str, Any]:
+def _run_agent_and_stream(ui_history: List[Dict[str, Any]], user_text: str, mode: str) -> Dict[str, Any]:
     """
-    Consuma event_stream(...) e aggiorna la UI:
+    Consuma gli eventi del core e aggiorna la UI:
       - scrive i token nel messaggio assistant
       - intercetta i blocchi di reasoning separati (kind="reasoning")
       - fallback: separa <think>...</think> dal content assistant
       - crea expander per ciascun tool (multi-tool con run_id)
+    event_stream gira sul loop di processo e passa gli eventi da una coda: qui (thread dello
+    script) si fa solo UI, e nelle pause dello stream (es. tool lunghi) i flush proseguono.
     """
-    final_text = ""
-    think_text = ""
-    tool_calls: List[Dict[str, Any]] = []  # [{name, inputs, output}...]
-
-    parse_state = {"in_think": False}
+    events: queue.SimpleQueue = queue.SimpleQueue()
+    pump = asyncio.run_coroutine_threadsafe(_pump_events(user_text, ui_history, mode, events), agent_event_loop())
 
     with st.chat_message("assistant"):
-        text_ph = st.empty()
-        think_expander = None
-        think_ph = None
-        tools_container = None
-        tool_placeholders: Dict[str, Dict[str, Any]] = {}
-
-        async for ev in event_stream(user_text, ui_history, mode=mode):
-            et = ev.get("type")
-            kind = ev.get("kind")  # "assistant" | "reasoning" | None (fallback)
-
-            if et == "token":
-                chunk = ev.get("text", "")
-
-                # ====== NUOVO: stream reasoning separato quando il core lo fornisce ======
-                if kind == "reasoning":
-                    # Accumula sempre; mostra solo se il toggle è attivo
-                    think_text += chunk
-                    if st.session_state.get("show_thinking"):
-                        if think_expander is None:
-                            think_expander = st.expander("🧠 Thinking", expanded=False)
-                            think_ph = think_expander.empty()
-                        think_ph.markdown(think_text)
-                    continue  # non mischiare nel testo visibile
-
-                # ====== OLD/FALLBACK: parsing dei tag <think> dentro il content assistant ======
-                vis, th = _stream_split_think(chunk, parse_state)
-
-                # testo visibile
-                if vis:
-                    final_text += vis
-                    text_ph.markdown(final_text)
-
-                # thinking estratto dai tag <think>...</think>
-                if th:
-                    think_text += th
-                    if st.session_state.get("show_thinking"):
-                        if think_expander is None:
-                            think_expander = st.expander("🧠 Thinking", expanded=False)
-                            think_ph = think_expander.empty()
-                        think_ph.markdown(think_text)
-
-                # se siamo *ancora* dentro <think>, aggiorna live l’expander (se visibile)
-                if parse_state["in_think"] and st.session_state.get("show_thinking"):
-                    if think_expander is None:
-                        think_expander = st.expander("🧠 Thinking", expanded=False)
-                        think_ph = think_expander.empty()
-                    # Forziamo il render dell'attuale contenuto accumulato
-                    think_ph.markdown(think_text)
-
-            elif et == "tool_start":
-                tname = ev.get("name", "tool")
-                trun  = ev.get("run_id") or f"run_{len(tool_calls)}"
-                tinp  = ev.get("inputs") or ev.get("input") or {}
-
-                tool_calls.append({"name": tname, "inputs": tinp, "output": None})
-                idx = len(tool_calls) - 1
-
-                if st.session_state.get("show_tools"):
-                    if tools_container is None:
-                        tools_container = st.container()
-                    exp = tools_container.expander(
-                        f"🔧 Eseguendo strumento: {tname}",
-                        expanded=False,
-                    )
-                    with exp:
-                        st.markdown("**Input**")
-                        input_ph = st.empty()
-                        st.markdown("**Output**")
-                        output_ph = st.empty()
-                    input_ph.code(tinp, language="json")
-                else:
-                    exp = input_ph = output_ph = None
-
-                tool_placeholders[trun] = {
-                    "idx": idx,
-                    "exp": exp,
-                    "input_ph": input_ph,
-                    "output_ph": output_ph,
-                }
-
-            elif et == "tool_end":
-                trun = ev.get("run_id")
-                tname = ev.get("name", "tool")
-                tout = ev.get("output", "")
-                tinp = ev.get("inputs") or ev.get("input") or {}
-
-                if trun not in tool_placeholders:
-                    tool_calls.append({"name": tname, "inputs": tinp, "output": None})
-                    idx = len(tool_calls) - 1
-                    if st.session_state.get("show_tools"):
-                        if tools_container is None:
-                            tools_container = st.container()
-                        exp = tools_container.expander(
-                            f"🔧 Eseguendo strumento: {tname}",
-                            expanded=False,
-                        )
-                        with exp:
-                            st.markdown("**Input**")
-                            input_ph = st.empty()
-                            st.markdown("**Output**")
-                            output_ph = st.empty()
-                        input_ph.code(tinp, language="json")
-                    else:
-                        exp = input_ph = output_ph = None
-                    tool_placeholders[trun] = {
-                        "idx": idx, "exp": exp, "input_ph": input_ph, "output_ph": output_ph
-                    }
-
-                ph = tool_placeholders[trun]
-                if st.session_state.get("show_tools") and ph["output_ph"] is not None:
-                    ph["output_ph"].code(tout, language="json")
-                tool_calls[ph["idx"]]["output"] = tout
-
-            elif et == "error":
-                err = f"**[Errore]** {ev.get('message')}"
-                final_text += ("\n\n" + err)
-                text_ph.markdown(final_text)
-                if st.session_state.get("show_tools"):
-                    if tools_container is None:
-                        tools_container = st.container()
-                    tools_container.error(err)
-
-            elif et == "done":
-                break
+        text_box = st.container()
+        ctx = _StreamCtx(
+            # Preferenze UI lette una sola volta (non cambiano durante lo streaming)
+            show_thinking=bool(st.session_state.get("show_thinking", True)),
+            show_tools=bool(st.session_state.get("show_tools", True)),
+            text_box=text_box,
+            text_ph=text_box.empty(),
+        )
 
+        try:
+            while True:
+                try:
+                    ev = events.get(timeout=_FLUSH_INTERVAL_S)
+                except queue.Empty:
+                    # stream fermo: mostra ciò che il throttling sta trattenendo
+                    if ctx.flush_state["text"][1] and ctx.due("text", "", force=True):
+                        ctx.render_text()
+                    if ctx.flush_state["think"][1]:
+                        ctx.flush_think(force=True)
+                    if ctx.ui_ops:
+                        ctx.drain_ui()
+                    continue
+                if ev is _STREAM_END:
+                    break
+                handler = _HANDLERS.get(ev.get("type"))
+                if handler and handler(ev, ctx):
+                    break
+                # UI dei tool a lotti: lo stream di eventi non si ferma ad ogni expander
+                if ctx.ui_ops and ctx.due("ui", ""):
+                    ctx.drain_ui()
+        finally:
+            # "done" (o un'eccezione) prima della fine del generatore: chiude lo stream sul loop
+            pump.cancel()
+
+        # Un eventuale frammento di tag mai completato è testo a tutti gli effetti
+        tail = ctx.parse_state.pop("buffer", "")
+        if tail:
+            if ctx.parse_state["in_think"]:
+                ctx.think_parts.append(tail)
+                ctx.flush_state["think"][1] += len(tail)
+            else:
+                ctx.final_parts.append(tail)
+                ctx.flush_state["text"][1] += len(tail)
+
+        # Flush finale: operazioni UI dei tool e caratteri rimasti in coda al throttling
+        ctx.drain_ui()
+        if ctx.flush_state["text"][1]:
+            ctx.render_text()
+        if ctx.think_parts and ctx.flush_state["think"][1]:
+            ctx.flush_think(force=True)
+
+    think_text = ctx.think_text
     return {
-        "text": final_text.strip(),
+        "text": ctx.final_text.strip(),
         "think": think_text.strip() if think_text else "",
-        "tools": tool_calls if tool_calls else [],
+        "tools": ctx.tool_calls if ctx.tool_calls else [],
+        "error": ctx.failed,
     }
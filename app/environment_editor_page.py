@@ -3,14 +3,17 @@
 Sezione Editor Ambientale (cross-platform):
 - Visualizza e permette di modificare il JSON 'dati_sensori.json'
 - Pulsante SALVA che valida e scrive su file
-- Autodiscovery di PROJECT_ROOT e app/data, override via ENV
+- Autodiscovery di PROJECT_ROOT e app/data, override via ENV (lazy, al primo render)
 """
 from __future__ import annotations
 import os
-import json
+import functools
 from pathlib import Path
 import streamlit as st
 
+# JSON (orjson/stdlib), lettura e scrittura atomica condivise con gli altri editor
+from utils.json_io import cached_read_json_text, write_json_text as _write_json_text
+
 # ─────────────────────────────────────────────────────────────────────────────
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -45,34 +48,23 @@ def _guess_project_root() -> Path:
 
     return cwd
 
-PROJECT_ROOT: Path = _guess_project_root()
-DATA_DIR: Path = Path(os.getenv("DATA_DIR", PROJECT_ROOT / "app" / "data"))
+# Discovery rimandata al primo uso e memoizzata: niente stat a import se la pagina non viene aperta
+@functools.lru_cache(maxsize=1)
+def project_root() -> Path:
+    return _guess_project_root()
+
+@functools.lru_cache(maxsize=1)
+def data_dir() -> Path:
+    return Path(os.getenv("DATA_DIR", project_root() / "app" / "data"))
 
 def _resolve_path_from_env(env_key: str, default_filename: str) -> Path:
     val = os.getenv(env_key)
-    return Path(val).expanduser().resolve() if val else (DATA_DIR / default_filename)
+    return Path(val).expanduser().resolve() if val else (data_dir() / default_filename)
 
 # Percorso finale (override ENV possibile)
-SENSOR_DATA_PATH: Path = _resolve_path_from_env("SENSOR_DATA_PATH", "dati_sensori.json")
-
-# ─────────────────────────────────────────────────────────────────────────────
-# I/O helpers
-def _read_json_text(path: Path) -> str:
-    if not path.exists():
-        return "[]"
-    with path.open("r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-            return json.dumps(data, ensure_ascii=False, indent=2)
-        except Exception:
-            f.seek(0)
-            return f.read()
-
-def _write_json_text(path: Path, text: str) -> None:
-    data = json.loads(text)  # valida JSON
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+@functools.lru_cache(maxsize=1)
+def sensor_data_path() -> Path:
+    return _resolve_path_from_env("SENSOR_DATA_PATH", "dati_sensori.json")
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Streamlit page (tool)
@@ -80,10 +72,11 @@ def render_environment_editor_page():
     st.title("🌿 Editor Dati Ambientali")
     st.caption("Modifica direttamente il file JSON delle misure sensori.")
 
-    st.markdown(f"**Percorso file (rilevato):** `{SENSOR_DATA_PATH}`")
+    path = sensor_data_path()
+    st.markdown(f"**Percorso file (rilevato):** `{path}`")
     text = st.text_area(
         "Contenuto JSON",
-        value=_read_json_text(SENSOR_DATA_PATH),
+        value=cached_read_json_text(path),
         height=500,
         help="Array di record con timestamp e misure. Il pulsante SALVA valida il JSON.",
     )
@@ -92,7 +85,7 @@ def render_environment_editor_page():
     with c1:
         if st.button("💾 Salva", type="primary"):
             try:
-                _write_json_text(SENSOR_DATA_PATH, text)
+                _write_json_text(path, text)
                 st.success("Dati ambientali salvati correttamente.")
             except Exception as e:
                 st.error(f"Errore di validazione/salvataggio: {e}")
@@ -9,17 +9,23 @@ Streamlit UI per agente LangChain + Ollama (OpenAI-compat) con:
 - Supporto MULTI-TOOL (mappa run_id → expander corretto)
 - Compatibile con versioni Streamlit che non supportano `key` in st.expander()
 """
-import json
 import os
+import gzip
+import json
+import uuid
+from pathlib import Path
 # Non filtriamo i blocchi <think> nel core, così la UI li visualizza.
 os.environ.setdefault("HIDE_THINK", "false")
 
+import re
+import time
+import queue
 import asyncio
 import streamlit as st
 from typing import Dict, Any, List, Tuple
 
 # Se il tuo core si chiama agent_core, cambia qui l'import.
-from utils.utils import event_stream, MODEL
+from utils.utils import event_stream, MODEL, agent_event_loop
 
 st.set_page_config(
     page_title="Ollama Agent (LangChain + Streamlit)",
@@ -28,16 +34,55 @@ st.set_page_config(
 )
 
 
+# Troncamento dell'output dei tool nella traccia LLM: 0 = disattivato (output integrale)
+TRUNC_LEN = int(os.getenv("TOOL_TRACE_TRUNC_LEN", "0"))
+_TRUNC_SUFFIX = ".....(OUTPUT TRONCATO, SE SI NECESSITA NUOVAMENTE L'OUTPUT INTEGRALE ALLORA RIESEGUIRE LO STRUMENTO!)"
+# Tool per messaggio riportati nella traccia LLM (i più vecchi oltre il limite sono omessi); 0 = tutti
+TRACE_MAX_TOOLS = int(os.getenv("TOOL_TRACE_MAX_TOOLS", "32"))
+
+def _json_text(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+def _other_text(value: Any) -> str:
+    # sottoclassi (es. OrderedDict) restano JSON come prima
+    if isinstance(value, (dict, list, tuple)):
+        return _json_text(value)
+    return str(value)
+
+# Conversione in stringa per tipo esatto (str è il caso comune: nessun isinstance)
+_DUMPERS = {
+    str: str,
+    bytes: lambda v: v.decode("utf-8", "replace"),
+    dict: _json_text,
+    list: _json_text,
+    tuple: _json_text,
+}
+
 def _truncate64(value: Any) -> str:
-    """Converte in stringa (JSON se dict/list) e tronca a 64 caratteri + '.....'."""
+    """Converte in stringa (JSON se dict/list) e, se TRUNC_LEN > 0, tronca + _TRUNC_SUFFIX."""
     try:
-        if isinstance(value, (dict, list, tuple)):
-            s = json.dumps(value, ensure_ascii=False)
-        else:
-            s = str(value)
+        s = _DUMPERS.get(type(value), _other_text)(value)
     except Exception:
         s = repr(value)
-    return s#[:64] + ".....(OUTPUT TRONCATO A 64 CARATTERI, SE SI NECESSITA NUOVAMENTE L'OUTPUT INTEGRALE ALLORA RIESEGUIRE LOS TRUMENTO!)"
+    if 0 < TRUNC_LEN < len(s):
+        return s[:TRUNC_LEN] + _TRUNC_SUFFIX
+    return s
+
+def _inputs_json(inputs: Any) -> str:
+    """Input del tool come JSON (str() se non serializzabile)."""
+    try:
+        return json.dumps(inputs, ensure_ascii=False)
+    except Exception:
+        return str(inputs)
+
+def _pretty(value: Any) -> str:
+    """Testo per st.code: JSON indentato per dict/list, str() per il resto."""
+    if isinstance(value, (dict, list, tuple)):
+        try:
+            return json.dumps(value, ensure_ascii=False, indent=2)
+        except Exception:
+            pass
+    return str(value)
 
 def _hidden_tool_trace_for_msg(msg: Dict[str, Any]) -> str:
     """
@@ -52,40 +97,91 @@ def _hidden_tool_trace_for_msg(msg: Dict[str, Any]) -> str:
     tools = msg.get("tools") or []
     if not tools:
         return ""
-    lines = ["", "<!-- TOOL_TRACE_START"]
+    parts = []
+    # Prompt più corto: solo gli ultimi TRACE_MAX_TOOLS tool del messaggio
+    omitted = len(tools) - TRACE_MAX_TOOLS if TRACE_MAX_TOOLS > 0 else 0
+    if omitted > 0:
+        tools = tools[omitted:]
+        parts.append(f"... {omitted} chiamate a strumenti precedenti omesse\n")
     for t in tools:
-        name = t.get("name", "tool")
-        inputs = t.get("inputs", {})
-        try:
-            inputs_json = json.dumps(inputs, ensure_ascii=False)
-        except Exception:
-            inputs_json = str(inputs)
-        out_trunc = _truncate64(t.get("output", ""))
-        lines.append(f"[tool] {name}")
-        lines.append(f"inputs: {inputs_json}")
-        lines.append(f"output_truncated: {out_trunc}")
-    lines.append("TOOL_TRACE_END -->")
-    return "\n".join(lines)
+        # Stringhe pre-serializzate all'arrivo degli eventi (record vecchi: calcolate qui)
+        inputs_json = t.get("inputs_json")
+        if inputs_json is None:
+            inputs_json = _inputs_json(t.get("inputs", {}))
+        out_trunc = t.get("output_trunc")
+        if out_trunc is None:
+            out_trunc = _truncate64(t.get("output", ""))
+        parts.append(f"[tool] {t.get('name', 'tool')}\ninputs: {inputs_json}\noutput_truncated: {out_trunc}\n")
+    return f"\n<!-- TOOL_TRACE_START\n{''.join(parts)}TOOL_TRACE_END -->"
+
+def _llm_content_for_msg(m: Dict[str, Any]) -> str:
+    """
+    Testo inviato all'LLM per il messaggio (contenuto + blocco tool nascosto).
+    Cachato in `m["_llm_cached"]` come (versione, testo): i messaggi passati non cambiano,
+    quindi a ogni turno si ricalcola solo l'ultimo. La versione invalida la cache se
+    contenuto o tool vengono modificati.
+    """
+    content = m.get("content", "")
+    version = (len(content), len(m.get("tools") or ()))
+    cached = m.get("_llm_cached")
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    # Appendi il blocco tool nascosto solo se ci sono strumenti nel messaggio
+    tool_block = _hidden_tool_trace_for_msg(m)
+    content_aug = (content + ("\n" + tool_block if tool_block else "")).strip()
+    m["_llm_cached"] = (version, content_aug)
+    return content_aug
 
 def build_llm_history(ui_messages: List[Dict[str, Any]], flatten_assistant: bool = True) -> List[Dict[str, Any]]:
     """
     Ritorna una *copia* della history con il riepilogo strumenti appeso nel testo.
     - Se flatten_assistant=True, i messaggi 'assistant' diventano 'user' (compat con utils che
       forwarda spesso solo HumanMessage); altrimenti mantiene i ruoli originali.
-    - NON modifica st.session_state.messages.
+    - NON modifica st.session_state.messages (a parte la cache `_llm_cached` dei singoli messaggi).
     """
-    llm_hist: List[Dict[str, Any]] = []
-    for m in ui_messages:
-        role = m.get("role", "user")
-        content = m.get("content", "")
-        # Appendi il blocco tool nascosto solo se ci sono strumenti nel messaggio
-        tool_block = _hidden_tool_trace_for_msg(m)
-        content_aug = (content + ("\n" + tool_block if tool_block else "")).strip()
-        if flatten_assistant and role == "assistant":
-            role = "user"
-        llm_hist.append({"role": role, "content": content_aug})
-    return llm_hist
+    roles = {"assistant": "user"} if flatten_assistant else {}
+    return [
+        {"role": roles.get(r, r), "content": _llm_content_for_msg(m)}
+        for m in ui_messages
+        for r in (m.get("role", "user"),)
+    ]
+
 
+# Messaggi tenuti in RAM (e inviati all'LLM); i più vecchi vanno nel file di overflow
+MAX_IN_RAM = int(os.getenv("MAX_CHAT_HISTORY", "50"))
+OVERFLOW_DIR = Path(os.getenv("CHAT_OVERFLOW_DIR", "~/.cache/jetson-agent")).expanduser()
+
+def _overflow_path() -> Path:
+    return OVERFLOW_DIR / f"overflow-{st.session_state._session_id}.jsonl.gz"
+
+def _spill_overflow():
+    """
+    Mantiene in RAM solo gli ultimi MAX_IN_RAM messaggi: i più vecchi vengono accodati
+    (JSONL compresso gzip, un membro per scrittura) al file di overflow della sessione e
+    non entrano più nella history LLM.
+    """
+    msgs = st.session_state.messages
+    excess = len(msgs) - MAX_IN_RAM
+    if MAX_IN_RAM <= 0 or excess <= 0:
+        return
+    old = msgs[:excess]
+    del msgs[:excess]
+    OVERFLOW_DIR.mkdir(parents=True, exist_ok=True)
+    with gzip.open(_overflow_path(), "at", encoding="utf-8") as f:
+        f.write("".join(
+            json.dumps({k: v for k, v in m.items() if not k.startswith("_")},
+                       ensure_ascii=False, default=str) + "\n"
+            for m in old
+        ))
+    st.session_state._overflow_count += excess
+
+def _load_overflow() -> List[Dict[str, Any]]:
+    """Legge (solo su richiesta) i messaggi spostati su disco."""
+    try:
+        with gzip.open(_overflow_path(), "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
 
 # -----------------------------------------------------------------------------
 # Sidebar: impostazioni / switch visibilità
@@ -108,6 +204,10 @@ with st.sidebar:
 
     if st.button("🧹 Svuota chat"):
         st.session_state.messages = []
+        if st.session_state.get("_overflow_count"):
+            _overflow_path().unlink(missing_ok=True)
+            st.session_state._overflow_count = 0
+            st.session_state._show_overflow = False
         st.rerun()
 
 # -----------------------------------------------------------------------------
@@ -115,12 +215,31 @@ with st.sidebar:
 # -----------------------------------------------------------------------------
 # Schema messaggio:
 #   {"role": "user"|"assistant", "content": str, "think": str|None, "tools": list|None}
+#   tools: [{"name", "inputs", "inputs_json", "inputs_pretty", "output", "output_trunc", "output_pretty"}]
+#          (*_json/*_trunc: stringhe per la traccia LLM; *_pretty: testo per st.code)
 if "messages" not in st.session_state:
     st.session_state.messages: List[Dict[str, Any]] = []
+if "_session_id" not in st.session_state:
+    st.session_state._session_id = uuid.uuid4().hex[:12]
+    st.session_state._overflow_count = 0
+    st.session_state._show_overflow = False
 
 st.title("🦙 Ollama + LangChain (Tool Calling) — Streamlit")
 st.caption("Chat con streaming, blocchi Thinking e log strumenti in-line (multi-tool).")
 
+def _fenced_json(text: str) -> str:
+    fence = "```" if "```" not in text else "~~~~~"
+    return f"{fence}json\n{text}\n{fence}"
+
+def _tool_markdown(t: Dict[str, Any]) -> str:
+    """Markdown Input/Output del tool per lo storico, calcolato una volta (cache in `t["_md"]`)."""
+    md = t.get("_md")
+    if md is None:
+        inputs = t.get("inputs_pretty") or _pretty(t.get("inputs", {}))
+        output = t.get("output_pretty") or _pretty(t.get("output", ""))
+        md = t["_md"] = f"**Input**\n{_fenced_json(inputs)}\n\n**Output**\n{_fenced_json(output)}"
+    return md
+
 # -----------------------------------------------------------------------------
 # Rendering storico (inclusi Thinking/Tool salvati)
 # -----------------------------------------------------------------------------
@@ -142,11 +261,17 @@ def render_message(m: Dict[str, Any]):
                         f"🔧 Eseguendo strumento: {t.get('name', 'tool')}",
                         expanded=False,
                     )
-                    with exp:
-                        st.markdown("**Input**")
-                        st.code(t.get("inputs", {}), language="json")
-                        st.markdown("**Output**")
-                        st.code(t.get("output", ""), language="json")
+                    # Un solo elemento markdown per tool (invece di 4) a ogni rerun
+                    exp.markdown(_tool_markdown(t))
+
+# Turni spostati su disco: caricati solo a richiesta
+if st.session_state._overflow_count:
+    if st.session_state._show_overflow:
+        for m in _load_overflow():
+            render_message(m)
+    elif st.button(f"⬆️ Carica turni precedenti ({st.session_state._overflow_count})"):
+        st.session_state._show_overflow = True
+        st.rerun()
 
 for m in st.session_state.messages:
     render_message(m)
@@ -155,70 +280,152 @@ for m in st.session_state.messages:
 # Helpers per lo stato della chat
 # -----------------------------------------------------------------------------
 def append_user_message(content: str):
-    st.session_state.messages.append(
-        {"role": "user", "content": content, "think": None, "tools": None}
-    )
+    msg = {"role": "user", "content": content, "think": None, "tools": None}
+    _llm_content_for_msg(msg)  # messaggio definitivo: testo per l'LLM calcolato una volta
+    st.session_state.messages.append(msg)
+    _spill_overflow()
 
 def append_assistant_message(content: str, think: str | None, tools: list | None):
-    st.session_state.messages.append(
-        {"role": "assistant", "content": content, "think": think, "tools": tools}
-    )
+    msg = {"role": "assistant", "content": content, "think": think, "tools": tools}
+    _llm_content_for_msg(msg)  # tool congelati a fine turno: traccia nascosta calcolata qui
+    st.session_state.messages.append(msg)
+    _spill_overflow()
 
 # -----------------------------------------------------------------------------
 # Parser in streaming per separare testo vs <think>...</think> (token-safe)
 # -----------------------------------------------------------------------------
+_THINK_RE = re.compile(r"<think>|</think>")
+# Tag atteso in base allo stato (in_think False/True): serve a trattenere i tag spezzati
+_THINK_TAGS = ("<think>", "</think>")
+
+
+def _partial_tag_len(text: str, tag: str) -> int:
+    """Lunghezza del suffisso di `text` che è un prefisso proprio di `tag` (0 se nessuno)."""
+    start = text.rfind("<", max(0, len(text) - len(tag) + 1))
+    if start != -1 and tag.startswith(text[start:]):
+        return len(text) - start
+    return 0
+
+
 def stream_split_think(chunk: str, state: Dict[str, Any]) -> Tuple[str, str]:
     """
     Aggiorna lo stato e ritorna (visible_text_delta, think_text_delta).
-    Stato richiesto: {'in_think': bool}
-    Gestisce tag spezzati sui token.
+    Stato richiesto: {'in_think': bool}; 'tail' (tag parziale trattenuto) è gestito qui.
+    Gestisce tag spezzati sui token: a fine stream usare stream_flush_think().
     """
-    visible_delta = ""
-    think_delta = ""
+    tail = state.get("tail", "")
+    # Caso comune: nessun "<" né tag parziale in sospeso → nessun tag possibile
+    if not tail and "<" not in chunk:
+        return ("", chunk) if state["in_think"] else (chunk, "")
+    if tail:
+        chunk = tail + chunk
+    in_think = state["in_think"]
+    parts: Tuple[List[str], List[str]] = ([], [])  # (visibile, thinking)
     i = 0
 
-    while i < len(chunk):
-        if not state["in_think"]:
-            start = chunk.find("<think>", i)
-            if start == -1:
-                visible_delta += chunk[i:]
-                break
-            visible_delta += chunk[i:start]
-            i = start + len("<think>")
-            state["in_think"] = True
-        else:
-            end = chunk.find("</think>", i)
-            if end == -1:
-                think_delta += chunk[i:]
-                break
-            think_delta += chunk[i:end]
-            i = end + len("</think>")
-            state["in_think"] = False
-
-    return visible_delta, think_delta
+    for m in _THINK_RE.finditer(chunk):
+        # Un tag "inatteso" (es. </think> fuori dal thinking) resta testo, come prima
+        if m.group() != _THINK_TAGS[in_think]:
+            continue
+        if m.start() > i:
+            parts[in_think].append(chunk[i:m.start()])
+        i = m.end()
+        in_think = not in_think
+
+    rest = chunk[i:]
+    keep = _partial_tag_len(rest, _THINK_TAGS[in_think]) if "<" in rest else 0
+    if keep:
+        rest, state["tail"] = rest[:-keep], rest[-keep:]
+    else:
+        state["tail"] = ""
+    if rest:
+        parts[in_think].append(rest)
+
+    state["in_think"] = in_think
+    return "".join(parts[0]), "".join(parts[1])
+
+
+def stream_flush_think(state: Dict[str, Any]) -> Tuple[str, str]:
+    """Rilascia a fine stream l'eventuale tag parziale trattenuto (non era un tag)."""
+    tail = state.get("tail", "")
+    state["tail"] = ""
+    return ("", tail) if state["in_think"] else (tail, "")
 
 # -----------------------------------------------------------------------------
 # Esecuzione agente + stream in UI (multi-tool con run_id)
 # -----------------------------------------------------------------------------
-async def run_agent_and_stream(ui_history: List[Dict[str, Any]], user_text: str) -> Dict[str, Any]:
+# Flush a lotti dei placeholder: ri-renderizza dopo FLUSH_MIN_CHARS caratteri o FLUSH_INTERVAL_S secondi
+FLUSH_MIN_CHARS = 512
+FLUSH_INTERVAL_S = 0.025
+
+def _flush_due(flush: List[float], n_chars: int) -> bool:
+    """Aggiorna i caratteri pendenti e dice se è ora di ri-renderizzare (azzera il contatore)."""
+    flush[1] += n_chars
+    now = time.monotonic()
+    if flush[1] >= FLUSH_MIN_CHARS or now - flush[0] >= FLUSH_INTERVAL_S:
+        flush[0], flush[1] = now, 0
+        return True
+    return False
+
+def _render_tail(parts: List[str], done: List[str], box: Any, ph: Any) -> Any:
+    """
+    Rendering a blocchi (in append, come st.write_stream): i paragrafi completati diventano
+    elementi statici e solo la coda (paragrafo in corso) viene ri-renderizzata ad ogni flush.
+    Ritorna il placeholder della coda (nuovo se un paragrafo è stato chiuso).
+    """
+    tail = "".join(parts)
+    cut = tail.rfind("\n\n")
+    # non spezzare un blocco ``` ancora aperto
+    if cut > 0 and tail.count("```", 0, cut) % 2 == 0:
+        ph.markdown(tail[:cut])
+        ph = box.empty()
+        done.append(tail[:cut + 2])
+        tail = tail[cut + 2:]
+        parts[:] = [tail]
+    ph.markdown(tail)
+    return ph
+
+_STREAM_END = object()  # sentinella: event_stream esaurito
+
+async def _pump_events(user_text: str, ui_history: List[Dict[str, Any]], q: queue.SimpleQueue):
+    """Consuma event_stream(...) sul loop di processo e inoltra gli eventi al thread dello script."""
+    try:
+        async for ev in event_stream(user_text, ui_history):
+            q.put(ev)
+    except Exception as e:
+        q.put({"type": "error", "message": str(e)})
+    finally:
+        q.put(_STREAM_END)
+
+def run_agent_and_stream(ui_history: List[Dict[str, Any]], user_text: str) -> Dict[str, Any]:
     """
     Consuma event_stream(...) e aggiorna la UI:
       - scrive i token nel messaggio assistant
       - intercetta i blocchi <think> (expander "🧠 Thinking", un SOLO placeholder aggiornato)
       - per ogni tool call crea un expander dedicato, mappato su run_id
+    event_stream gira sul loop di processo e passa gli eventi da una coda: le chiamate
+    Streamlit restano tutte sul thread dello script.
     Ritorna:
       {"text": <risposta_senza_think>, "think": <contenuto_think_o_vuoto>, "tools": <lista_tool_call>}
     """
-    final_text = ""
-    think_text = ""
+    events: queue.SimpleQueue = queue.SimpleQueue()
+    pump = asyncio.run_coroutine_threadsafe(_pump_events(user_text, ui_history, events), agent_event_loop())
+
+    final_parts: List[str] = []  # coda del testo (paragrafo in corso)
+    done_parts: List[str] = []   # paragrafi già renderizzati in elementi statici
+    think_parts: List[str] = []
+    # [ultimo_flush_monotonic, caratteri_pendenti] per testo e thinking
+    text_flush = [time.monotonic(), 0]
+    think_flush = [time.monotonic(), 0]
     tool_calls: List[Dict[str, Any]] = []  # [{name, inputs, output}...]
 
     # Stato parser <think>
-    parse_state = {"in_think": False}
+    parse_state = {"in_think": False, "tail": ""}
 
     with st.chat_message("assistant"):
-        # Placeholder principale per il testo
-        text_ph = st.empty()
+        # Testo: contenitore dei paragrafi + placeholder della coda
+        text_box = st.container()
+        text_ph = text_box.empty()
 
         # Thinking (creato solo alla prima necessità)
         think_expander = None
@@ -227,138 +434,159 @@ async def run_agent_and_stream(ui_history: List[Dict[str, Any]], user_text: str)
         # Contenitore strumenti (creato alla prima tool-call se visibile)
         tools_container = None
 
-        # Mappa dei tool in corso: run_id -> placeholders & index in tool_calls
-        tool_placeholders: Dict[str, Dict[str, Any]] = {}
-        # Esempio:
-        # tool_placeholders[run_id] = {
-        #   "idx": int, "exp": <st.expander>, "input_ph": st.empty(), "output_ph": st.empty()
-        # }
-
-        async for ev in event_stream(user_text, ui_history):
-            et = ev.get("type")
-
-            # --- token di testo (potrebbe contenere <think>) ---
-            if et == "token":
-                chunk = ev.get("text", "")
-                vis, th = stream_split_think(chunk, parse_state)
-
-                if vis:
-                    final_text += vis
-                    text_ph.markdown(final_text)
-
-                if (th or parse_state["in_think"]) and show_thinking:
-                    if think_expander is None:
-                        think_expander = st.expander("🧠 Thinking", expanded=False)
-                        think_ph = think_expander.empty()
-                    if th:
-                        think_text += th
-                        think_ph.markdown(think_text)
-
-            # --- inizio tool: crea expander dedicato SOLO all'arrivo dell'evento ---
-            elif et == "tool_start":
-                # Normalizza campi: alcune versioni emettono 'input', altre 'inputs'
-                tname = ev.get("name", "tool")
-                trun  = ev.get("run_id") or f"run_{len(tool_calls)}"
-                tinp  = ev.get("inputs")
-                if tinp is None:
-                    tinp = ev.get("input")  # fallback
-                if tinp is None:
-                    tinp = {}
-
-                # Aggiungi un record persistente
-                tool_calls.append({"name": tname, "inputs": tinp, "output": None})
-                idx = len(tool_calls) - 1
-
-                # UI solo se abilitata
-                if show_tools:
-                    if tools_container is None:
-                        tools_container = st.container()
-
-                    # Expander per questo tool
-                    exp = tools_container.expander(
-                        f"🔧 Eseguendo strumento: {tname}",
-                        expanded=False,
-                    )
-                    with exp:
-                        st.markdown("**Input**")
-                        input_ph = st.empty()
-                        st.markdown("**Output**")
-                        output_ph = st.empty()
-
-                    input_ph.code(tinp, language="json")
+        # Tool per slot (stesso indice di tool_calls): run_id -> slot, e placeholder
+        # dell'output per slot (expander e input sono scritti una volta sola e non servono più)
+        run_id_to_slot: Dict[str, int] = {}
+        output_phs: List[Any] = []
+
+        def open_tool(trun: str, tname: str, tinp: Any) -> int:
+            """Registra il tool (e, se visibile, il suo expander) e ritorna lo slot."""
+            nonlocal tools_container
+            tool_calls.append({
+                "name": tname, "inputs": tinp, "inputs_json": _inputs_json(tinp),
+                "inputs_pretty": _pretty(tinp),
+                "output": None, "output_trunc": None, "output_pretty": None,
+            })
+            output_ph = None
+            if show_tools:
+                if tools_container is None:
+                    tools_container = st.container()
+                with tools_container.expander(f"🔧 Eseguendo strumento: {tname}", expanded=False):
+                    st.markdown("**Input**")
+                    input_ph = st.empty()
+                    st.markdown("**Output**")
+                    output_ph = st.empty()
+                input_ph.code(tool_calls[-1]["inputs_pretty"], language="json")
+            output_phs.append(output_ph)
+            run_id_to_slot[trun] = len(tool_calls) - 1
+            return run_id_to_slot[trun]
+
+        pending = None  # evento già estratto dalla coda durante il batching dei token
+        try:
+            while True:
+                if pending is not None:
+                    ev, pending = pending, None
                 else:
-                    exp = None
-                    input_ph = None
-                    output_ph = None
-
-                # Mappa run_id → placeholders e indice
-                tool_placeholders[trun] = {
-                    "idx": idx,
-                    "exp": exp,
-                    "input_ph": input_ph,
-                    "output_ph": output_ph,
-                }
-
-            # --- fine tool: aggiorna l'expander giusto tramite run_id ---
-            elif et == "tool_end":
-                trun  = ev.get("run_id")
-                tname = ev.get("name", "tool")
-                tout  = ev.get("output", "")
-                tinp  = ev.get("inputs")
-                if tinp is None:
-                    tinp = ev.get("input")  # fallback
-                if tinp is None:
-                    tinp = {}
-
-                # Se non abbiamo visto il tool_start, creiamo al volo
-                if trun not in tool_placeholders:
-                    tool_calls.append({"name": tname, "inputs": tinp, "output": None})
-                    idx = len(tool_calls) - 1
-
+                    try:
+                        ev = events.get(timeout=FLUSH_INTERVAL_S)
+                    except queue.Empty:
+                        # stream fermo (es. tool lungo): mostra quanto trattenuto dal batching
+                        if text_flush[1]:
+                            text_ph = _render_tail(final_parts, done_parts, text_box, text_ph)
+                            text_flush[:] = [time.monotonic(), 0]
+                        if think_flush[1] and think_ph is not None:
+                            think_ph.markdown("".join(think_parts))
+                            think_flush[:] = [time.monotonic(), 0]
+                        continue
+                if ev is _STREAM_END:
+                    break
+                et = ev.get("type")
+
+                # --- token di testo (potrebbe contenere <think>) ---
+                if et == "token":
+                    chunk = ev.get("text", "")
+                    # Token già in coda (la UI è più lenta della rete): un solo parse/flush per il lotto
+                    batch = None
+                    while True:
+                        try:
+                            nxt = events.get_nowait()
+                        except queue.Empty:
+                            break
+                        if nxt is _STREAM_END or nxt.get("type") != "token":
+                            pending = nxt
+                            break
+                        if batch is None:
+                            batch = [chunk]
+                        batch.append(nxt.get("text", ""))
+                    if batch is not None:
+                        chunk = "".join(batch)
+                    vis, th = stream_split_think(chunk, parse_state)
+
+                    if vis:
+                        final_parts.append(vis)
+                        if _flush_due(text_flush, len(vis)):
+                            text_ph = _render_tail(final_parts, done_parts, text_box, text_ph)
+
+                    if (th or parse_state["in_think"]) and show_thinking:
+                        if think_expander is None:
+                            think_expander = st.expander("🧠 Thinking", expanded=False)
+                            think_ph = think_expander.empty()
+                        if th:
+                            think_parts.append(th)
+                            if _flush_due(think_flush, len(th)):
+                                think_ph.markdown("".join(think_parts))
+
+                # --- inizio tool: crea expander dedicato SOLO all'arrivo dell'evento ---
+                elif et == "tool_start":
+                    # Normalizza campi: alcune versioni emettono 'input', altre 'inputs'
+                    tname = ev.get("name", "tool")
+                    trun  = ev.get("run_id") or f"run_{len(tool_calls)}"
+                    tinp  = ev.get("inputs")
+                    if tinp is None:
+                        tinp = ev.get("input")  # fallback
+                    if tinp is None:
+                        tinp = {}
+
+                    open_tool(trun, tname, tinp)
+
+                # --- fine tool: aggiorna l'expander giusto tramite run_id ---
+                elif et == "tool_end":
+                    trun  = ev.get("run_id")
+                    tname = ev.get("name", "tool")
+                    tout  = ev.get("output", "")
+                    tinp  = ev.get("inputs")
+                    if tinp is None:
+                        tinp = ev.get("input")  # fallback
+                    if tinp is None:
+                        tinp = {}
+
+                    # Se non abbiamo visto il tool_start, creiamo al volo
+                    slot = run_id_to_slot.get(trun)
+                    if slot is None:
+                        slot = open_tool(trun, tname, tinp)
+
+                    # Aggiorna stato persistente + UI
+                    tool = tool_calls[slot]
+                    tool["output"] = tout
+                    tool["output_trunc"] = _truncate64(tout)
+                    tool["output_pretty"] = _pretty(tout)
+                    if output_phs[slot] is not None:
+                        output_phs[slot].code(tool["output_pretty"], language="json")
+
+                # --- errore: mostra e prosegui ---
+                elif et == "error":
+                    err = f"**[Errore]** {ev.get('message')}"
+                    final_parts.append("\n\n" + err)
+                    text_ph = _render_tail(final_parts, done_parts, text_box, text_ph)
+                    text_flush[1] = 0
                     if show_tools:
                         if tools_container is None:
                             tools_container = st.container()
-                        exp = tools_container.expander(
-                            f"🔧 Eseguendo strumento: {tname}",
-                            expanded=False,
-                        )
-                        with exp:
-                            st.markdown("**Input**")
-                            input_ph = st.empty()
-                            st.markdown("**Output**")
-                            output_ph = st.empty()
-                        input_ph.code(tinp, language="json")
-                    else:
-                        exp = None
-                        input_ph = None
-                        output_ph = None
-
-                    tool_placeholders[trun] = {
-                        "idx": idx,
-                        "exp": exp,
-                        "input_ph": input_ph,
-                        "output_ph": output_ph,
-                    }
-
-                # Aggiorna UI + stato persistente
-                ph = tool_placeholders[trun]
-                if show_tools and ph["output_ph"] is not None:
-                    ph["output_ph"].code(tout, language="json")
-                tool_calls[ph["idx"]]["output"] = tout
-
-            # --- errore: mostra e prosegui ---
-            elif et == "error":
-                err = f"**[Errore]** {ev.get('message')}"
-                final_text += ("\n\n" + err)
-                text_ph.markdown(final_text)
-                if show_tools:
-                    if tools_container is None:
-                        tools_container = st.container()
-                    tools_container.error(err)
-
-            # --- fine della run ---
-            elif et == "done":
-                break
+                        tools_container.error(err)
+
+                # --- fine della run ---
+                elif et == "done":
+                    break
+        finally:
+            # "done" (o un'eccezione) prima della fine del generatore: chiude lo stream sul loop
+            pump.cancel()
+
+        # Tag parziale rimasto a fine stream: era testo normale
+        vis, th = stream_flush_think(parse_state)
+        if vis:
+            final_parts.append(vis)
+            text_flush[1] += len(vis)
+        if th and show_thinking:
+            think_parts.append(th)
+            think_flush[1] += len(th)
+
+        # Flush finale di quanto trattenuto dal batching
+        if text_flush[1]:
+            _render_tail(final_parts, done_parts, text_box, text_ph)
+        final_text = "".join(done_parts) + "".join(final_parts)
+        think_text = "".join(think_parts)
+        if think_flush[1] and think_ph is not None:
+            think_ph.markdown(think_text)
 
     return {
         "text": final_text.strip(),
@@ -377,12 +605,12 @@ if user_text:
         st.markdown(user_text)
     append_user_message(user_text)
 
-    # Esegui agente e streamma la risposta (Streamlit è sync → asyncio.run)
+    # Esegui agente e streamma la risposta (event_stream gira sul loop persistente di processo)
     # Costruisci la history *solo per l'LLM*, con i tool inseriti nel testo (nascosti alla UI)
     llm_history = build_llm_history(st.session_state.messages, flatten_assistant=True)
 
     # Passa la history arricchita all'agente (la UI continua a renderizzare la history originale)
-    result = asyncio.run(run_agent_and_stream(llm_history, user_text))
+    result = run_agent_and_stream(llm_history, user_text)
 
     # Persisti risposta assistant con Thinking/Tools salvati
     append_assistant_message(
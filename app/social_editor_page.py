@@ -7,10 +7,12 @@ Sezione Editor Social (cross-platform):
 """
 from __future__ import annotations
 import os
-import json
 from pathlib import Path
 import streamlit as st
 
+# JSON (orjson/stdlib), lettura e scrittura atomica condivise con gli altri editor
+from utils.json_io import cached_read_json_text, write_json_text as _write_json_text
+
 
 def _guess_project_root() -> Path:
     pr_env = os.getenv("PROJECT_ROOT")
@@ -39,23 +41,6 @@ def _resolve_path_from_env(env_key: str, default_filename: str) -> Path:
 
 SOCIAL_DATA_PATH: Path = _resolve_path_from_env("SOCIAL_DATA_PATH", "social_kpis.json")
 
-def _read_json_text(path: Path) -> str:
-    if not path.exists():
-        return "[]"
-    with path.open("r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-            return json.dumps(data, ensure_ascii=False, indent=2)
-        except Exception:
-            f.seek(0)
-            return f.read()
-
-def _write_json_text(path: Path, text: str) -> None:
-    data = json.loads(text)  # valida
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
 def render_social_editor_page():
     st.title("👥 Editor Dati Social")
     st.caption("Modifica direttamente il file JSON usato dai tool social.")
@@ -63,7 +48,7 @@ def render_social_editor_page():
     st.markdown(f"**Percorso file (rilevato):** `{SOCIAL_DATA_PATH}`")
     text = st.text_area(
         "Contenuto JSON",
-        value=_read_json_text(SOCIAL_DATA_PATH),
+        value=cached_read_json_text(SOCIAL_DATA_PATH),
         height=500,
         help="Modifica liberamente. Il pulsante SALVA valida il JSON prima di scrivere.",
     )
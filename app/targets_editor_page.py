@@ -7,10 +7,12 @@ Sezione Editor Target KPI (cross-platform):
 """
 from __future__ import annotations
 import os
-import json
 from pathlib import Path
 import streamlit as st
 
+# JSON (orjson/stdlib), lettura e scrittura atomica condivise con gli altri editor
+from utils.json_io import dumps_pretty as _dumps_pretty, cached_read_json_text, write_json_text as _write_json_text
+
 # opzionale .e
 def _guess_project_root() -> Path:
     pr_env = os.getenv("PROJECT_ROOT")
@@ -39,26 +41,11 @@ def _resolve_path_from_env(env_key: str, default_filename: str) -> Path:
 
 KPI_TARGETS_PATH: Path = _resolve_path_from_env("KPI_TARGETS_PATH", "kpi_targets.json")
 
-def _read_json_text(path: Path) -> str:
-    if not path.exists():
-        # template minimo se assente (i tool lo bootstrapperanno comunque)
-        return json.dumps({
-            "environment": {"trend_epsilon": 0.1, "trend_window_n": 5},
-            "social": {"trend_epsilon": 0.1, "trend_window_n": 3}
-        }, ensure_ascii=False, indent=2)
-    with path.open("r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-            return json.dumps(data, ensure_ascii=False, indent=2)
-        except Exception:
-            f.seek(0)
-            return f.read()
-
-def _write_json_text(path: Path, text: str) -> None:
-    data = json.loads(text)  # valida
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+# template minimo se il file è assente (i tool lo bootstrapperanno comunque)
+_MISSING_TEMPLATE = _dumps_pretty({
+    "environment": {"trend_epsilon": 0.1, "trend_window_n": 5},
+    "social": {"trend_epsilon": 0.1, "trend_window_n": 3}
+}).decode("utf-8")
 
 def render_targets_editor_page():
     st.title("🎯 Editor Target KPI")
@@ -67,7 +54,7 @@ def render_targets_editor_page():
     st.markdown(f"**Percorso file (rilevato):** `{KPI_TARGETS_PATH}`")
     text = st.text_area(
         "Contenuto JSON",
-        value=_read_json_text(KPI_TARGETS_PATH),
+        value=cached_read_json_text(KPI_TARGETS_PATH, _MISSING_TEMPLATE),
         height=600,
         help="Modifica liberamente. Il pulsante SALVA valida il JSON prima di scrivere.",
     )
@@ -3,6 +3,12 @@
 # ─────────────────────────────────────────────────────────────────────────────
 from typing import List, Tuple, Dict, Any
 
+# NumPy (opzionale): pesi e lambda_max vettoriali; senza NumPy si usano i loop Python
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - fallback senza numpy
+    np = None
+
 # Random Index (Saaty) per n = 1..10
 _AHP_RI = {1: 0.0, 2: 0.0, 3: 0.58, 4: 0.90, 5: 1.12, 6: 1.24, 7: 1.32, 8: 1.41, 9: 1.45, 10: 1.49}
 
@@ -18,11 +24,23 @@ FIN_KPI_ORDER = [
 ]
 
 
-def _ahp_weights_and_cr(matrix: List[List[float]]) -> Tuple[List[float], float]:
-    """Calcola i pesi AHP (metodo della media geometrica) e il Consistency Ratio."""
+def _ahp_eigen_numpy(matrix: List[List[float]]) -> Tuple[List[float], float]:
+    """Pesi (media geometrica) e lambda_max con NumPy."""
+    M = np.asarray(matrix, dtype=np.float64)
+    n = M.shape[0]
+    if (M > 0).all():
+        # media geometrica via log: niente overflow del prodotto per n grandi
+        g = np.exp(np.log(M).mean(axis=1))
+    else:
+        g = np.prod(M, axis=1) ** (1.0 / n)
+    w = g / (g.sum() or 1.0)  # pesi normalizzati
+    Aw = M @ w
+    lambda_max = float((Aw / np.where(w == 0, 1e-12, w)).mean())
+    return w.tolist(), lambda_max
+
+def _ahp_eigen_py(matrix: List[List[float]]) -> Tuple[List[float], float]:
+    """Pesi (media geometrica) e lambda_max in Python puro."""
     n = len(matrix)
-    if n == 0 or any(len(row) != n for row in matrix):
-        raise ValueError("Matrice AHP non quadrata o vuota.")
     # media geometrica per riga
     g = []
     for i in range(n):
@@ -33,14 +51,22 @@ def _ahp_weights_and_cr(matrix: List[List[float]]) -> Tuple[List[float], float]:
     s = sum(g) or 1.0
     w = [gi / s for gi in g]  # pesi normalizzati
 
-    # lambda_max
-    Aw = []
+    # lambda_max = media di (A·w)_i / w_i, in un solo passaggio (senza la lista A·w)
+    lm_sum = 0.0
     for i in range(n):
+        row = matrix[i]
         val = 0.0
         for j in range(n):
-            val += float(matrix[i][j]) * w[j]
-        Aw.append(val)
-    lambda_max = sum((Aw[i] / (w[i] or 1e-12)) for i in range(n)) / n
+            val += float(row[j]) * w[j]
+        lm_sum += val / (w[i] or 1e-12)
+    return w, lm_sum / n
+
+def _ahp_weights_and_cr(matrix: List[List[float]]) -> Tuple[List[float], float]:
+    """Calcola i pesi AHP (metodo della media geometrica) e il Consistency Ratio."""
+    n = len(matrix)
+    if n == 0 or any(len(row) != n for row in matrix):
+        raise ValueError("Matrice AHP non quadrata o vuota.")
+    w, lambda_max = (_ahp_eigen_numpy if np is not None else _ahp_eigen_py)(matrix)
 
     # Consistency Ratio
     ci = (lambda_max - n) / (n - 1) if n > 2 else 0.0
@@ -48,9 +74,15 @@ def _ahp_weights_and_cr(matrix: List[List[float]]) -> Tuple[List[float], float]:
     cr = (ci / ri) if ri > 0 else 0.0
     return w, cr
 
-def _pairwise_equal_matrix(n: int) -> List[List[float]]:
-    """Matrice di confronto 'tutti uguali' (peso uniforme)."""
-    return [[1.0 if i == j else 1.0 for j in range(n)] for i in range(n)]
+def _pairwise_equal_matrix(n: int) -> "np.ndarray | List[List[float]]":
+    """
+    Matrice di confronto 'tutti uguali' (peso uniforme). Con NumPy è una vista broadcast
+    in sola lettura (nessuna allocazione n×n): i chiamanti la passano solo a
+    `_ahp_weights_and_cr`, senza modificarla.
+    """
+    if np is not None:
+        return np.broadcast_to(1.0, (n, n))
+    return [[1.0] * n for _ in range(n)]
 
 def _status_to_norm01(status: str) -> float:
     """Mappa lo status a normalizzazione 0–1 coerente con i punteggi (green=1.0, yellow=0.8, red=0.5, na=0)."""
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+I/O JSON delle pagine editor (sensori, social, target KPI), in un solo posto:
+- parse/serializzazione con orjson se installato, altrimenti stdlib
+- lettura del file come testo per l'editor (via mmap)
+- validazione + scrittura atomica del testo salvato (i tool leggono gli stessi file
+  in concorrenza: devono vedere il file vecchio o quello nuovo, mai uno troncato)
+"""
+from __future__ import annotations
+import os
+import json
+import mmap
+import functools
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+# JSON: orjson (UTF-8 nativo, in C) se installato, altrimenti stdlib
+try:
+    import orjson
+
+    loads = orjson.loads
+
+    def dumps_pretty(data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+except ImportError:  # pragma: no cover - fallback senza orjson
+    def loads(raw):
+        # json.loads non accetta memoryview (lettura via mmap)
+        return json.loads(bytes(raw) if isinstance(raw, memoryview) else raw)
+
+    def dumps_pretty(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+# Byte/caratteri iniziali ispezionati per capire se il JSON è già indentato
+_INDENT_PROBE = 256
+
+
+def looks_indented(head: str | bytes) -> bool:
+    """True se l'inizio del JSON contiene un a capo seguito da indentazione."""
+    probe = head[:_INDENT_PROBE]
+    return (b"\n " if isinstance(probe, bytes) else "\n ") in probe
+
+
+def read_json_text(path: Path, missing: str = "[]") -> str:
+    """
+    Testo del file per l'editor, letto via mmap (niente copia intermedia prima del parse).
+    Se il JSON è valido e già indentato viene restituito così com'è, senza il giro
+    parse → re-serializzazione; `missing` se il file non esiste.
+    """
+    if not path.exists():
+        return missing
+    with path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            try:
+                data = loads(view)
+            except ValueError:
+                return str(view, "utf-8", errors="replace")
+            if looks_indented(mm[:_INDENT_PROBE]):
+                return str(view, "utf-8")
+    return dumps_pretty(data).decode("utf-8")
+
+
+# Ultimo testo letto per file, con la versione (mtime_ns, size) da cui proviene
+_TEXT_CACHE: Dict[str, Tuple[Optional[int], Optional[int], str]] = {}
+_TEXT_CACHE_LOCK = threading.Lock()
+
+
+def cached_read_json_text(path: Path, missing: str = "[]") -> str:
+    """
+    `read_json_text` con cache di processo per (path, mtime_ns, size): i rerun delle pagine
+    editor dovuti ad altri widget costano un solo stat se il file non è cambiato, e un
+    salvataggio (nuova versione del file) invalida la voce da sé. La size copre i
+    filesystem con mtime a grana grossa (es. FAT: 2 s).
+    """
+    try:
+        s = path.stat()
+        mtime_ns, size = s.st_mtime_ns, s.st_size
+    except OSError:
+        mtime_ns = size = None
+    key = str(path)
+    with _TEXT_CACHE_LOCK:
+        hit = _TEXT_CACHE.get(key)
+    if hit is not None and hit[0] == mtime_ns and hit[1] == size:
+        return hit[2]
+    text = read_json_text(path, missing)
+    with _TEXT_CACHE_LOCK:
+        _TEXT_CACHE[key] = (mtime_ns, size, text)
+    return text
+
+
+def atomic_write_bytes(path: Path, data: bytes) -> None:
+    """
+    Scrittura atomica: payload già completo in memoria, scritto con os.write su un file
+    temporaneo nella stessa cartella, fsync e os.replace. Un lettore (es. i tool dei
+    report) vede sempre il file vecchio o quello nuovo, mai uno troncato.
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        # mkstemp crea il file 0600: si mantengono i permessi del file sostituito
+        try:
+            os.chmod(tmp, path.stat().st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(tmp, 0o644)
+        view = memoryview(data)
+        while view:  # os.write può scrivere meno byte di quelli richiesti
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+        os.close(fd)
+        fd = -1
+        os.replace(tmp, path)
+    except BaseException:
+        if fd >= 0:
+            os.close(fd)
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+@functools.lru_cache(maxsize=8)
+def _ensure_dir(directory: Path) -> None:
+    """mkdir una sola volta per cartella (i salvataggi successivi non rifanno la syscall)."""
+    directory.mkdir(parents=True, exist_ok=True)
+
+
+def write_json_text(path: Path, text: str) -> None:
+    """
+    Valida il JSON e scrive il testo dell'utente così com'è (niente re-serializzazione);
+    viene re-indentato solo se arriva compatto. L'albero del parse serve solo alla
+    validazione e viene rilasciato subito.
+    """
+    data = loads(text)  # valida (solleva se non valido)
+    if looks_indented(text):
+        del data
+        raw = text.encode("utf-8")
+    else:
+        raw = dumps_pretty(data)
+        del data
+    _ensure_dir(path.parent)
+    atomic_write_bytes(path, raw)
+
+
+__all__ = [
+    "loads",
+    "dumps_pretty",
+    "looks_indented",
+    "read_json_text",
+    "cached_read_json_text",
+    "atomic_write_bytes",
+    "write_json_text",
+]
@@ -1,49 +1,50 @@
 # -*- coding: utf-8 -*-
-
-AGENT_ENV_SYSTEM_MESSAGE = """
-Sei **ENV-Agent**, specialista di monitoraggio e reportistica **ambientale ESG** per un’azienda tessile (lino).
-Obiettivo: produrre snapshot e report fedeli ai dati, senza inventare nulla.
-
-REGOLE GENERALI
-- Rispondi in **italiano**, stile chiaro e sintetico.
-- Non eseguire operazioni matematiche 'a mano' ma usa sempre i valori restituiti dai dati a disposizione.
-- Se il range richiesto non ha dati, restituisci un avviso conciso e indica il range usato.
-- Evita di ragionare per troppo tempo se hai già i dati e le informazioni necessarie per rispondere all'utente.
-
-VINCOLI
-- Non introdurre conversioni non definite. Se un KPI manca: mostra **N/D** con stato **⚪**.
-- Mantieni l’ordine KPI del template. Mostra lo **score** con la fascia: *Eccellente 90–100*, *Buono 70–89*, *Critico <70*.
-
-"""
-
-AGENT_SOC_SYSTEM_MESSAGE = """
-Sei **SOC-Agent**, specialista di monitoraggio e reportistica **sociale ESG**.
-Obiettivo: valutare KPI sociali vs **target** e produrre report aderenti al template.
-
-REGOLE GENERALI
-- Italiano, tono professionale e conciso. **Niente catene di pensiero**.
-- Non eseguire operazioni matematiche 'a mano' ma usa sempre i valori mostrati nei dati a disposizione.
-- Se non ci sono dati nel range, segnala in modo breve e indica il range usato.
-- Evita di ragionare per troppo tempo se hai già i dati e le informazioni necessarie per rispondere all'utente.
-
-VINCOLI
-- Se un KPI è assente: **N/D** con **⚪**.
-- Riporta lo **score** medio e la fascia: *Eccellente 90–100*, *Buono 70–89*, *Critico <70*.
-- Mantieni l’ordine KPI del template sociale.
-"""
-
-
-AGENT_DSS_SYSTEM_MESSAGE = """
-Sei **DSS-Agent**, analista **AHP/DSS** per priorità ESG (azienda tessile – lino).
-Obiettivo: produrre un **report decisionale** (markdown o JSON) combinando categorie **Ambientale/Sociale/Finanziario**.
-
-REGOLE
-- Italiano, stile chiaro e conciso. Niente catene di pensiero.
-- Non eseguire operazioni matematiche 'a mano' ma usa sempre i valori mostrati nei dati a disposizione.
-- Se l’utente chiede priorità/score: usa `generate_dss_report`.
-
-VINCOLI
-- Se CR>0.1, segnala nel report.
-- Se la finestra dati è vuota, indica **N/D** e procedi comunque (con pesi AHP e FIN simulati).
-"""
-
+# System prompt dei tre agenti (ENV / SOC / DSS). Il testo sta in prompts/*.md (modificabile
+# senza toccare il codice); qui viene letto e normalizzato una sola volta all'import.
+# Testo in chiaro volutamente: sono ~2 KB in totale, e il prefisso della chiamata resta
+# identico tra le richieste (vedi utils.py).
+import re
+import sys
+from functools import lru_cache
+from pathlib import Path
+
+PROMPTS_DIR = Path(__file__).resolve().parent / "prompts"
+
+_TABLE_PAD_RE = re.compile(r" {2,}")
+_BLANK_RUN_RE = re.compile(r"\n{3,}")
+
+
+def _normalize(text: str) -> str:
+    """
+    Meno token a parità di contenuto: niente spazi in coda alle righe, padding delle
+    tabelle markdown ridotto a uno spazio, righe vuote consecutive collassate, niente
+    a capo iniziali/finali.
+    """
+    lines = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if line.lstrip().startswith("|"):
+            line = _TABLE_PAD_RE.sub(" ", line)
+        lines.append(line)
+    return _BLANK_RUN_RE.sub("\n\n", "\n".join(lines)).strip()
+
+
+@lru_cache(maxsize=None)
+def _load(name: str) -> str:
+    """
+    Legge e normalizza prompts/<name> (una volta per processo). Il testo è internato: chi
+    lo importa condivide lo stesso oggetto, e i confronti/lookup per prompt si risolvono
+    per identità. Riferire le costanti, non ricostruirle.
+    """
+    return sys.intern(_normalize((PROMPTS_DIR / name).read_text(encoding="utf-8")))
+
+
+AGENT_ENV_SYSTEM_MESSAGE = _load("env_agent.md")
+AGENT_SOC_SYSTEM_MESSAGE = _load("soc_agent.md")
+AGENT_DSS_SYSTEM_MESSAGE = _load("dss_agent.md")
+
+__all__ = [
+    "AGENT_ENV_SYSTEM_MESSAGE",
+    "AGENT_SOC_SYSTEM_MESSAGE",
+    "AGENT_DSS_SYSTEM_MESSAGE",
+]
@@ -23,6 +23,8 @@ from __future__ import annotations
 import os
 import json
 import math
+import bisect
+import threading
 from pathlib import Path
 import statistics
 from typing import List, Dict, Any, Optional, Tuple, Literal
@@ -30,6 +32,26 @@ from datetime import datetime, date
 from pydantic import BaseModel, Field, validator
 from langchain_core.tools import StructuredTool
 
+# JSON: orjson (parser C, input bytes) se installato, altrimenti stdlib
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:  # pragma: no cover - fallback senza orjson
+    _loads = json.loads
+
+# ijson (opzionale): parsing incrementale dei file sensori molto grandi
+try:
+    import ijson
+except ImportError:  # pragma: no cover - fallback senza ijson
+    ijson = None
+
+# NumPy (opzionale): colonne numeriche dei sensori per i trend; senza NumPy si scorrono i record
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - fallback senza numpy
+    np = None
+
 from .dss_utils import _status_to_norm01, FIN_KPI_ORDER, _ahp_weights_and_cr, ENV_KPI_FOR_DSS, \
     _pairwise_equal_matrix, _has_thresholds
 
@@ -76,6 +98,9 @@ SENSOR_DATA_PATH = Path(os.getenv("SENSOR_DATA_PATH", DATA_DIR / "dati_sensori.j
 SOCIAL_DATA_PATH = Path(os.getenv("SOCIAL_DATA_PATH", DATA_DIR / "social_kpis.json"))
 KPI_TARGETS_PATH = Path(os.getenv("KPI_TARGETS_PATH", DATA_DIR / "kpi_targets.json"))
 
+# Oltre questa dimensione il file sensori si parsa in streaming (se ijson è installato)
+STREAM_PARSE_MIN_BYTES = int(os.getenv("STREAM_PARSE_MIN_BYTES", str(64 * 1024 * 1024)))
+
 # ─────────────────────────────────────────────────────────────────────────────
 # DEFAULT TARGETS (bootstrap se file mancante)
 # ─────────────────────────────────────────────────────────────────────────────
@@ -142,25 +167,116 @@ def _load_targets() -> Dict[str, Any]:
 # ─────────────────────────────────────────────────────────────────────────────
 # Utility: caricamento dataset
 # ─────────────────────────────────────────────────────────────────────────────
-def _load_env_rows() -> List[Dict[str, Any]]:
-    if not SENSOR_DATA_PATH.exists():
-        return []
-    with SENSOR_DATA_PATH.open("r", encoding="utf-8") as f:
-        data = json.load(f)
-    if not isinstance(data, list):
-        return []
-    data = [r for r in data if isinstance(r, dict) and "timestamp" in r]
+# Dataset già parsati per path → (mtime_ns, size, righe): più tool nella stessa sessione
+# agente rileggono lo stesso file, che si riparsa solo quando cambia su disco.
+_ROWS_CACHE: Dict[str, Tuple[int, int, List[Dict[str, Any]], Dict[str, Any]]] = {}
+_ROWS_CACHE_LOCK = threading.Lock()  # i StructuredTool possono girare in parallelo
+
+
+def _cached_entry(path: Path, parse) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+    """
+    (righe, derivati) di `path` via `parse(path)`, memorizzati per (mtime_ns, size); None se
+    il file non esiste. `derivati` è un dict per dati calcolati dalle righe (es. indice date),
+    valido finché il file non cambia.
+    """
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    key = str(path)
+    with _ROWS_CACHE_LOCK:
+        hit = _ROWS_CACHE.get(key)
+    if hit is not None and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+        return hit[2], hit[3]
+    rows, derived = parse(path), {}
+    with _ROWS_CACHE_LOCK:
+        _ROWS_CACHE[key] = (st.st_mtime_ns, st.st_size, rows, derived)
+    return rows, derived
+
+
+def _cached_rows(path: Path, parse) -> List[Dict[str, Any]]:
+    """
+    Righe di `path` (vedi `_cached_entry`), come copie superficiali: chiamanti e chiamanti
+    dei tool possono modificare lista e record senza alterare la cache.
+    """
+    entry = _cached_entry(path, parse)
+    return [dict(r) for r in entry[0]] if entry is not None else []
+
+
+def _parse_env_rows(path: Path) -> List[Dict[str, Any]]:
+    if ijson is not None and path.stat().st_size >= STREAM_PARSE_MIN_BYTES:
+        # un record alla volta, filtrato al volo: in memoria resta solo la lista finale
+        with path.open("rb") as f:
+            data = [r for r in ijson.items(f, "item", use_float=True)
+                    if isinstance(r, dict) and "timestamp" in r]
+    else:
+        data = _loads(path.read_bytes())
+        if not isinstance(data, list):
+            return []
+        data = [r for r in data if isinstance(r, dict) and "timestamp" in r]
     data.sort(key=lambda r: r["timestamp"])
+    # 'acceleration' (m/s^2) → 'vibration_g', una volta al parse (i record in cache non si toccano più)
+    for r in data:
+        if "acceleration" in r and "vibration_g" not in r:
+            try:
+                r["vibration_g"] = float(r["acceleration"]) / 9.81
+            except Exception:
+                pass
     return data
 
 
-def _load_social_rows() -> List[Dict[str, Any]]:
-    if not SOCIAL_DATA_PATH.exists():
-        return []
-    with SOCIAL_DATA_PATH.open("r", encoding="utf-8") as f:
-        data = json.load(f)
+def _parse_social_rows(path: Path) -> List[Dict[str, Any]]:
+    data = _loads(path.read_bytes())
     return data if isinstance(data, list) else []
 
+
+def _load_env_rows() -> List[Dict[str, Any]]:
+    return _cached_rows(SENSOR_DATA_PATH, _parse_env_rows)
+
+
+def _load_env_rows_indexed() -> Tuple[List[Dict[str, Any]], Optional[List[datetime]]]:
+    """
+    Come `_load_env_rows` (copie dei record), più le date dei record già parsate (allineate alle righe,
+    crescenti) per la selezione per data via bisect; None se non utilizzabili.
+    """
+    entry = _cached_entry(SENSOR_DATA_PATH, _parse_env_rows)
+    if entry is None:
+        return [], None
+    rows, derived = entry
+    if "ts" not in derived:
+        derived["ts"] = _ts_index(rows)
+    return [dict(r) for r in rows], derived["ts"]
+
+
+def _env_column_value(r: Dict[str, Any], key: str) -> float:
+    v = r.get(key)
+    try:
+        return float(v) if v is not None else math.nan
+    except Exception:
+        return math.nan
+
+
+def _env_columns(keys: List[str]) -> Dict[str, Any]:
+    """
+    Colonne float64 dei record ENV (ordine crescente, NaN = valore assente/non numerico),
+    costruite una volta per versione del file e per campo. {} senza NumPy.
+    """
+    if np is None:
+        return {}
+    entry = _cached_entry(SENSOR_DATA_PATH, _parse_env_rows)
+    if entry is None:
+        return {}
+    rows, derived = entry
+    cols = derived.setdefault("cols", {})
+    for k in keys:
+        if k not in cols:
+            cols[k] = np.fromiter((_env_column_value(r, k) for r in rows), dtype=np.float64, count=len(rows))
+    return {k: cols[k] for k in keys}
+
+
+def _load_social_rows() -> List[Dict[str, Any]]:
+    return _cached_rows(SOCIAL_DATA_PATH, _parse_social_rows)
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Utility: date/filtri/formatting
 # ─────────────────────────────────────────────────────────────────────────────
@@ -176,6 +292,63 @@ def _parse_dt(s: str) -> datetime:
         pass
     return datetime.strptime(s, "%Y-%m")
 
+def _ts_index(rows: List[Dict[str, Any]]) -> Optional[List[datetime]]:
+    """
+    Date parsate dei record (ordinati per timestamp). None se una data non è parsabile,
+    se naive/aware sono mescolate o se l'ordine non è cronologico: in quei casi si usa
+    il filtro lineare.
+    """
+    keys: List[datetime] = []
+    aware = None
+    for r in rows:
+        try:
+            k = _parse_dt(str(r.get("timestamp")))
+        except Exception:
+            return None
+        if aware is None:
+            aware = k.tzinfo is not None
+        elif aware != (k.tzinfo is not None):
+            return None
+        keys.append(k)
+    if any(a > b for a, b in zip(keys, keys[1:])):
+        return None
+    return keys
+
+def _filter_desc_by_date(desc: List[Dict[str, Any]], key: str, d0: datetime, d1: datetime) -> List[Dict[str, Any]]:
+    """Filtro lineare (estremi inclusi): salta i record con data non parsabile."""
+    subset = []
+    for r in desc:
+        try:
+            rd = _parse_dt(str(r.get(key)))
+        except Exception:
+            continue
+        if rd >= d0 and rd <= d1:
+            subset.append(r)
+    return subset
+
+def _env_desc_by_date(base: List[Dict[str, Any]], ts: Optional[List[datetime]],
+                      date_start: Optional[str], date_end: Optional[str]) -> List[Dict[str, Any]]:
+    """
+    Record ENV (vista discendente) con data in [date_start, date_end], estremi inclusi.
+    Con l'indice `ts` (vedi `_ts_index`) sono due bisect sulle date già parsate; una data
+    senza fuso è letta nel fuso dei record.
+    """
+    d0 = _parse_dt(date_start) if date_start else None
+    d1 = _parse_dt(date_end) if date_end else None
+    if ts is None:
+        return _filter_desc_by_date(list(reversed(base)), "timestamp",
+                                    d0 or datetime.min, d1 or datetime.max)
+    tz = ts[0].tzinfo if ts else None
+
+    def _align(d: datetime) -> datetime:
+        if (d.tzinfo is None) == (tz is None):
+            return d
+        return d.replace(tzinfo=tz)
+
+    i = bisect.bisect_left(ts, _align(d0)) if d0 else 0
+    j = bisect.bisect_right(ts, _align(d1)) if d1 else len(ts)
+    return base[i:j][::-1]
+
 def _fmt_num(v: Any, decimals: int = 1) -> str:
     if v is None:
         return "N/D"
@@ -391,15 +564,9 @@ def read_kpi_data_tool(args: ReadKpiDataArgs) -> Dict[str, Any]:
     fields = args.fields or []
     order = args.order or "desc"
 
+    ts = None
     if kind == "env":
-        base = _load_env_rows()
-        # convertiamo 'acceleration' (m/s^2) in 'vibration_g' se presente
-        for r in base:
-            if "acceleration" in r and "vibration_g" not in r:
-                try:
-                    r["vibration_g"] = float(r["acceleration"]) / 9.81
-                except Exception:
-                    pass
+        base, ts = _load_env_rows_indexed()  # 'vibration_g' già derivato al parse
         key_dt = "timestamp"
         # dataset ascendente per timestamp → per indici invertiamo
     else:
@@ -425,6 +592,8 @@ def read_kpi_data_tool(args: ReadKpiDataArgs) -> Dict[str, Any]:
             else:
                 subset = desc[i1:i0+1]
 
+        elif kind == "env":  # by == date, record ordinati: bisect sulle date indicizzate
+            subset = _env_desc_by_date(base, ts, args.date_start, args.date_end)
         else:  # by == date
             d0 = _parse_dt(args.date_start) if args.date_start else datetime.min
             d1 = _parse_dt(args.date_end) if args.date_end else datetime.max
@@ -483,6 +652,25 @@ def _trend_delta(rows_desc: List[Dict[str, Any]], key: str, win: int) -> Optiona
         return None
     return cur - (sum(prev) / len(prev))
 
+def _trend_deltas(cols: Dict[str, Any], keys: List[str], win: int) -> Dict[str, Optional[float]]:
+    """
+    `_trend_delta` per tutti i `keys` dalle colonne di `_env_columns`, in un solo passaggio
+    sulla matrice (KPI × record): il rango dal fondo dei valori validi individua l'ultimo
+    (rango 1) e i `win` precedenti.
+    """
+    M = np.vstack([cols[k] for k in keys])
+    valid = ~np.isnan(M)
+    rank = np.cumsum(valid[:, ::-1], axis=1)[:, ::-1]  # valori validi da qui alla fine
+    vals = np.where(valid, M, 0.0)
+    cur = np.where(rank == 1, vals, 0.0).sum(axis=1)
+    in_prev = valid & (rank >= 2) & (rank <= win + 1)
+    n_prev = in_prev.sum(axis=1)
+    prev_sum = np.where(in_prev, vals, 0.0).sum(axis=1)
+    out: Dict[str, Optional[float]] = {}
+    for i, k in enumerate(keys):
+        out[k] = float(cur[i] - prev_sum[i] / n_prev[i]) if n_prev[i] else None
+    return out
+
 # ─────────────────────────────────────────────────────────────────────────────
 # TOOL 2 — Report Ambientale
 # ─────────────────────────────────────────────────────────────────────────────
@@ -564,15 +752,8 @@ def generate_environment_report_tool(args: EnvReportArgs) -> Any:
     trend_eps = float(targets.get("trend_epsilon", 0.1))
     win_n = int(targets.get("trend_window_n", 5))
 
-    base = _load_env_rows()
-    desc = list(reversed(base))  # più recente → prima
-    # conversione vibrazioni
-    for r in desc:
-        if "acceleration" in r and "vibration_g" not in r:
-            try:
-                r["vibration_g"] = float(r["acceleration"]) / 9.81
-            except Exception:
-                pass
+    base, ts = _load_env_rows_indexed()
+    desc = list(reversed(base))  # più recente → prima ('vibration_g' già derivato al parse)
 
     # selezione
     if args.by == "index":
@@ -582,16 +763,7 @@ def generate_environment_report_tool(args: EnvReportArgs) -> Any:
         i1 = min(max(i1, 0), max(len(desc)-1, 0))
         subset = desc[min(i0, i1):max(i0, i1)+1]
     else:
-        d0 = _parse_dt(args.date_start) if args.date_start else datetime.min
-        d1 = _parse_dt(args.date_end) if args.date_end else datetime.max
-        subset = []
-        for r in desc:
-            try:
-                rd = _parse_dt(str(r.get("timestamp")))
-            except Exception:
-                continue
-            if rd >= d0 and rd <= d1:
-                subset.append(r)
+        subset = _env_desc_by_date(base, ts, args.date_start, args.date_end)
 
     period_start = subset[-1]["timestamp"] if subset else (base[0]["timestamp"] if base else "N/D")
     period_end   = subset[0]["timestamp"] if subset else (base[-1]["timestamp"] if base else "N/D")
@@ -600,6 +772,8 @@ def generate_environment_report_tool(args: EnvReportArgs) -> Any:
     rows = []
     scores = []
     areas_green, areas_red_or_yellow = [], []
+    cols = _env_columns([k for k, _ in ENV_KPI_ORDER])  # {} senza NumPy → _trend_delta
+    deltas = _trend_deltas(cols, list(cols), win_n) if cols else {}
 
     for k, label in ENV_KPI_ORDER:
         tdef = targets.get(k, {})
@@ -616,7 +790,7 @@ def generate_environment_report_tool(args: EnvReportArgs) -> Any:
             value = None
 
         # trend
-        delta = _trend_delta(desc, k, win_n)
+        delta = deltas[k] if cols else _trend_delta(desc, k, win_n)
         trend = _trend_arrow(delta, trend_eps)
 
         # status
@@ -1218,7 +1392,7 @@ def generate_dss_report_tool(args: DSSReportArgs) -> Any:
     t_soc = targets_all.get("social", {})
 
     # ENV: carica e seleziona subset
-    env_base = _load_env_rows()
+    env_base, env_ts = _load_env_rows_indexed()
     env_desc = list(reversed(env_base))
     if args.by == "index":
         i0 = args.idx_start or 0
@@ -1227,23 +1401,7 @@ def generate_dss_report_tool(args: DSSReportArgs) -> Any:
         i1 = min(max(i1, 0), max(len(env_desc)-1, 0))
         env_subset = env_desc[min(i0, i1):max(i0, i1)+1]
     else:
-        d0 = _parse_dt(args.date_start) if args.date_start else datetime.min
-        d1 = _parse_dt(args.date_end) if args.date_end else datetime.max
-        env_subset = []
-        for r in env_desc:
-            try:
-                rd = _parse_dt(str(r.get("timestamp")))
-            except Exception:
-                continue
-            if d0 <= rd <= d1:
-                env_subset.append(r)
-    # conversione vibrazioni se serve
-    for r in env_subset:
-        if "acceleration" in r and "vibration_g" not in r:
-            try:
-                r["vibration_g"] = float(r["acceleration"]) / 9.81
-            except Exception:
-                pass
+        env_subset = _env_desc_by_date(env_base, env_ts, args.date_start, args.date_end)
 
     # SOCIAL: carica e seleziona subset
     soc_base = _load_social_rows()
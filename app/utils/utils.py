@@ -20,8 +20,9 @@ Env richieste & default:
   OLLAMA_MODEL     (default: qwen3:8b)
   AGENT_TEMPERATURE (default: 0.2)
   HIDE_THINK       (default: true)  # se true, NON emette reasoning
-  OLLAMA_KEEP_ALIVE (default: "0s") # 0s = scarica subito il modello (utile per debug)
+  OLLAMA_KEEP_ALIVE (default: "5m") # "0s" = scarica subito il modello (utile per debug, ma perde la cache del prompt)
   OLLAMA_NUM_CTX   (default: 8192)
+  OLLAMA_WARMUP_MODE (default: "")  # es. "env": precalcola all'avvio il prefisso (system + placeholder) di quella modalità
   REASONING_EFFORT (default: "")    # es. "medium" (inoltrato come extra_body → "reasoning": {"effort": ...})
 """
 
@@ -29,6 +30,8 @@ from __future__ import annotations
 import os
 import re
 import json
+import asyncio
+import threading
 from typing import AsyncIterator, Literal, List, Dict, Any
 
 from openai import OpenAI
@@ -53,8 +56,11 @@ MODEL    = os.environ.get("OLLAMA_MODEL", "qwen3:8b") #"qwen3:8b")
 TEMPERATURE = float(os.environ.get("AGENT_TEMPERATURE", "0.2"))
 HIDE_THINK  = os.environ.get("HIDE_THINK", "true").lower() in ("1", "true", "yes")
 
-KEEP_ALIVE  = os.environ.get("OLLAMA_KEEP_ALIVE", "0s")   # "0s" per debug; es. "5m" in prod
+# Il modello (e con lui la KV-cache del prefisso di prompt) resta caricato tra le richieste;
+# "0s" per debug, ma ogni turno rifà il prefill completo di system prompt e placeholder
+KEEP_ALIVE  = os.environ.get("OLLAMA_KEEP_ALIVE", "5m")
 NUM_CTX     = int(os.environ.get("OLLAMA_NUM_CTX", "8192"))
+WARMUP_MODE = os.environ.get("OLLAMA_WARMUP_MODE", "").strip()
 REASONING_EFFORT = os.environ.get("REASONING_EFFORT", "").strip()  # opzionale
 
 
@@ -77,6 +83,7 @@ print("BASE_URL=", BASE_URL)
 print("API_KEY=", API_KEY)
 print("MODEL=", MODEL)
 print("KEEP_ALIVE=", KEEP_ALIVE)
+print("WARMUP_MODE=", WARMUP_MODE or "(none)")
 print("NUM_CTX=", NUM_CTX)
 print("HIDE_THINK=", HIDE_THINK)
 print("REASONING_EFFORT=", REASONING_EFFORT or "(none)")
@@ -94,6 +101,18 @@ _MODE_CONFIG = {
     "dss":   {"system_message": AGENT_DSS_SYSTEM_MESSAGE,  "run_name": "DSS-Agent"},
 }
 
+# Prefisso statico della chiamata, costruito una sola volta all'import: messaggio system e
+# coppia placeholder (il cui scheletro report richiede l'esecuzione dei tool) sono identici
+# ad ogni richiesta. Restando byte-identico, il prefisso è anche riusabile dalla cache del
+# prompt lato server (la tokenizzazione avviene in Ollama, non qui).
+for _mode, _cfg in _MODE_CONFIG.items():
+    _cfg["system_msg"] = {"role": "system", "content": _cfg["system_message"]}
+    _cfg["placeholder_turn"] = [
+        {"role": "user", "content": PH_USER_TEXT[_mode]},
+        {"role": "assistant", "content": PH_ASSISTANT_TEXT[_mode]},
+    ]
+del _mode, _cfg
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Utilità
 # ─────────────────────────────────────────────────────────────────────────────
@@ -104,15 +123,17 @@ def _strip_think(text: str) -> str:
         return _THINK_RE.sub("", text)
     return text or ""
 
-def _build_messages(system_message: str, chat_history: List[Dict[str, Any]], user_text: str) -> List[Dict[str, str]]:
+def _build_messages(system_message: str | Dict[str, str], chat_history: List[Dict[str, Any]], user_text: str) -> List[Dict[str, str]]:
     """
     Costruisce l'array messages per /chat/completions in questo ordine:
-      - system
+      - system (testo, o messaggio già costruito da riusare così com'è)
       - history (user / assistant così come sono, se presenti)
       - ultimo user_text
     """
     msgs: List[Dict[str, str]] = []
-    if system_message:
+    if isinstance(system_message, dict):
+        msgs.append(system_message)
+    elif system_message:
         msgs.append({"role": "system", "content": system_message})
 
     # La tua UI passava in precedenza solo messaggi 'user' in lc_history; qui accettiamo anche 'assistant'
@@ -135,6 +156,74 @@ def _build_messages(system_message: str, chat_history: List[Dict[str, Any]], use
         msgs.append({"role": "user", "content": str(user_text)})
     return msgs
 
+def _extra_body() -> Dict[str, Any]:
+    """extra_body per Ollama-compat (options/keep_alive) + reasoning opzionale."""
+    extra_body: Dict[str, Any] = {
+        "options": {"num_ctx": NUM_CTX},  # num_ctx diverso = modello ricaricato (cache persa)
+        "keep_alive": KEEP_ALIVE,
+    }
+    if REASONING_EFFORT:
+        # Alcuni backend supportano un campo "reasoning": {"effort": "..."} (sarà ignorato se non supportato)
+        extra_body["reasoning"] = {"effort": REASONING_EFFORT}
+    return extra_body
+
+def warm_prefix_cache(mode: Mode = "env") -> None:
+    """
+    Precalcola sul server la KV-cache del prefisso statico della modalità (system + coppia
+    placeholder) con una richiesta da 1 token: Ollama riusa il prefisso comune alla
+    richiesta successiva, che salta così il prefill di quella parte.
+    """
+    cfg = _MODE_CONFIG[mode]
+    try:
+        client.chat.completions.create(
+            model=MODEL,
+            temperature=TEMPERATURE,
+            max_tokens=1,
+            messages=[cfg["system_msg"], *cfg["placeholder_turn"]],
+            extra_body=_extra_body(),
+        )
+    except Exception as e:
+        print(f"[warmup] prefisso '{mode}' non precalcolato: {e}")
+
+if WARMUP_MODE in _MODE_CONFIG:
+    # in background: l'import (e quindi l'avvio della UI) non attende il prefill
+    threading.Thread(target=warm_prefix_cache, args=(WARMUP_MODE,), name="prefix-warmup", daemon=True).start()
+
+_STREAM_EOF = object()  # sentinella: chunk dello stream esauriti
+
+# Event loop di processo su cui le pagine Streamlit eseguono event_stream (vedi `agent_event_loop`)
+_loop_lock = threading.Lock()
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_thread: threading.Thread | None = None
+
+
+def _new_event_loop() -> asyncio.AbstractEventLoop:
+    """uvloop se installato (e non disabilitato con JETSON_NO_UVLOOP=1), altrimenti asyncio."""
+    if os.getenv("JETSON_NO_UVLOOP", "").lower() not in ("1", "true", "yes"):
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            pass
+    return asyncio.new_event_loop()
+
+
+def agent_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Event loop persistente, uno per processo, su un thread daemon dedicato: nessun
+    `asyncio.run` (loop creato e distrutto) ad ogni messaggio, e nessun thread/loop per
+    sessione da fermare a fine sessione. Gli stream di più sessioni girano in concorrenza
+    sullo stesso loop; ogni turno riceve i propri eventi dalla sua coda.
+    """
+    global _loop, _loop_thread
+    with _loop_lock:
+        # un loop chiuso o rimasto senza thread (fermato) non eseguirebbe più nulla: se ne crea uno nuovo
+        if _loop is None or _loop.is_closed() or _loop_thread is None or not _loop_thread.is_alive():
+            _loop = _new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="agent-event-loop", daemon=True)
+            _loop_thread.start()
+        return _loop
+
 # ─────────────────────────────────────────────────────────────────────────────
 # EVENT STREAM (UI contract invariato)
 # ─────────────────────────────────────────────────────────────────────────────
@@ -151,7 +240,6 @@ async def event_stream(user_text: str, chat_history: list[dict], mode: Mode = "e
         yield {"type": "error", "message": f"Modalità non valida: {mode}. Valori ammessi: env | social | dss"}
         return
 
-    system_message = cfg["system_message"]
     run_name = cfg["run_name"]
 
     # Log di debug della history in ingresso
@@ -163,43 +251,40 @@ async def event_stream(user_text: str, chat_history: list[dict], mode: Mode = "e
             print(str(m))
         print("*" * 120)
 
-    messages = _build_messages(system_message, chat_history, user_text)
+    messages = _build_messages(cfg["system_msg"], chat_history, user_text)
 
-    # ⬇️ Inietta SOLO nella chiamata API una coppia user+assistant di placeholder
-    placeholder_turn = [
-        {"role": "user", "content": PH_USER_TEXT[mode]},
-        {"role": "assistant", "content": PH_ASSISTANT_TEXT[mode]},
-    ]
-    messages_for_call = messages[:-1] + placeholder_turn + messages[-1:]  # <-- NON tocca chat_history né la persistenza
+    # ⬇️ Inietta SOLO nella chiamata API una coppia user+assistant di placeholder (precostruita),
+    # subito dopo il system: system + placeholder sono il prefisso statico, identico ad ogni
+    # turno anche con history (è quello precalcolato da `warm_prefix_cache`)
+    messages_for_call = messages[:1] + cfg["placeholder_turn"] + messages[1:]  # <-- NON tocca chat_history né la persistenza
 
     for m in messages_for_call:
         print("#*"*120)
         print(m)
         print("#*" * 120)
 
-    # extra_body per Ollama-compat (options/keep_alive) + reasoning opzionale
-    extra_body = {
-        "options": {"num_ctx": NUM_CTX},
-        "keep_alive": KEEP_ALIVE,
-    }
-    if REASONING_EFFORT:
-        # Alcuni backend supportano un campo "reasoning": {"effort": "..."} (sarà ignorato se non supportato)
-        extra_body["reasoning"] = {"effort": REASONING_EFFORT}
+    extra_body = _extra_body()
 
     try:
+        # Client sync (pool HTTP keep-alive condiviso) ma letture bloccanti fuori dal loop:
+        # ogni chunk arriva tramite asyncio.to_thread, così il generatore cede il controllo e
+        # la cancellazione del task che lo consuma interrompe lo stream (chiuso nel finally,
+        # il server smette di generare)
         # NB: nella SDK moderna è possibile passare extra_body direttamente
-        with client.chat.completions.create(
+        stream = await asyncio.to_thread(
+            client.chat.completions.create,
             model=MODEL,
             stream=True,
             temperature=TEMPERATURE,
             messages=messages_for_call,
             extra_body=extra_body,   # inoltra options/keep_alive/reasoning a Ollama
-        ) as stream:
-
+        )
+        chunks = iter(stream)
+        try:
             # Accumulatori opzionali (se servono per debug)
             # full_reasoning, full_text = [], []
 
-            for ev in stream:
+            while (ev := await asyncio.to_thread(next, chunks, _STREAM_EOF)) is not _STREAM_EOF:
                 # Debug a console dell'evento grezzo
                 print("#" * 120)
                 print(ev)  # rappresentazione del ChatCompletionChunk
@@ -232,6 +317,8 @@ async def event_stream(user_text: str, chat_history: list[dict], mode: Mode = "e
                 if finish == "stop":
                     # Fine naturale della generazione
                     yield {"type": "done"}
+        finally:
+            stream.close()
 
         # In alcuni backend lo stop può non attivarsi: garantisci un done
         # (se già emesso sopra, la UI ignorerà i duplicati)
@@ -243,6 +330,7 @@ async def event_stream(user_text: str, chat_history: list[dict], mode: Mode = "e
 
 __all__ = [
     "event_stream",
+    "agent_event_loop",
     "MODEL",
     "HIDE_THINK",
 ]